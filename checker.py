@@ -1,19 +1,16 @@
+from array import array
+from protocol import KEY_TYPE
+import loader
 import sys
 
 if len(sys.argv) <= 2:
     print('uso: $ {} <arquivo original> <arquivo ordenado>'.format(sys.argv[0]))
     sys.exit(1)
 
-with open(sys.argv[1], 'r') as file:
-    original = file.readlines()
-    original = list(map(int, original))
-    original.sort()
+original = array(KEY_TYPE, sorted(loader.load_keys(sys.argv[1])))
+sorted = loader.load_keys(sys.argv[2])
 
-with open(sys.argv[2], 'r') as file:
-    sorted = file.readlines()
-    sorted = list(map(int, sorted))
-
-if original == sorted:
+if original == array(KEY_TYPE, sorted):
     print('A ordenação está correta')
 else:
     print('Há uma falha na ordenação')
@@ -1,68 +1,179 @@
 from list_manager import list_manager
+from protocol import KEY_TYPE, BINARY
+import protocol
+import merge
+import loader
 from leader import leader
 import threading
+import selectors
 import socket
-import json
+import struct
+from array import array
 import sys
 import datetime
 
 BUFFER_SIZE = 4096   # tamanho do buffer de recebimento de dados
 LEADER_PORT = 30000  # porta de escuta do líder para envio de endereço
 F_DATA_PORT = 50000  # porta de escuta para conexão de dados do líder
+F_FETCH_PORT = 50001  # porta de escuta para as listas buscadas pelos workers
+BACKLOG = 1024       # conexões diretas de workers aguardando aceitação
+SELECT_TIMEOUT = 0.5  # espera máxima (s) do laço de eventos das buscas
+RUN_SIZE = 1024      # tamanho dos blocos ordenados localmente pelos workers
+FAN_IN = 4           # número de listas intercaladas em cada tarefa
+LOCAL_SIZE = 1 << 16  # listas até este tamanho são ordenadas localmente
+SPLIT_SIZE = 1 << 16  # intercalações maiores são divididas entre workers
+LEADER_PASSES = 1    # iterações conduzidas por cada líder (0: sem eleições)
+RESULT_TEXT = 'result.txt'  # arquivo do resultado, um inteiro por linha
+RESULT_BINARY = 'result.bin'  # arquivo do resultado em inteiros de 32 bits
 
 
 class first():
 
     """Classe responsável pela entrega e recebimento dos trabalhos"""
 
-    def __init__(self, filename, debug=False):
-        self._num_list = list_manager(self._get_num_list(filename))
-        self._leader_addr = None  # endereço ipv4 do líder
+    def __init__(self, filename, debug=False, run_size=RUN_SIZE,
+                 fan_in=FAN_IN, wire_format=BINARY, local=False,
+                 local_size=LOCAL_SIZE, split_size=SPLIT_SIZE,
+                 leader_passes=LEADER_PASSES, direct=False,
+                 binary_input=None, external=None, binary_output=False):
         self._debug = debug
 
         if self._debug:
             self._file = open('first_log_{}.txt'.format(
                 datetime.datetime.now().strftime('%H_%M_%S')), 'w')
 
+        self._loaded = 0  # décimos do arquivo já carregados
+        # com external, as chaves ficam em dois arquivos mapeados nesse
+        # diretório, um de entrada e outro de saída a cada iteração
+        if external:
+            num_list, spare = self._get_external(
+                filename, external, binary_input)
+        else:
+            num_list, spare = self._get_num_list(filename, binary_input), None
+        self._num_list = list_manager(num_list, run_size, fan_in,
+                                      split_size, spare)
+        self._leader_addr = None  # endereço ipv4 do líder
+        self._leader_port = F_DATA_PORT  # porta de dados do líder
+        self._next_leader = None  # endereço e porta informados no repasse
+        self._wire_format = wire_format  # formato das tarefas enviadas
+        self._local = local  # ordena sem líder nem workers
+        self._local_size = local_size  # tamanho máximo ordenado localmente
+        self._leader_passes = leader_passes  # iterações por líder
+        self._passes_led = 0  # iterações conduzidas pelo líder atual
+        self._seen_iter = 0  # última iteração informada ao líder
+        # com direct, os workers buscam as listas e entregam os resultados
+        # diretamente ao primeiro, e o líder recebe somente os bilhetes
+        self._direct = direct
+        self._fetch_socket = None  # socket de escuta dos workers
+        self._serving = True  # o laço de eventos das buscas continua
+        self._fetch_thread_done = threading.Event()  # laço encerrado
+        self._lock = threading.Lock()  # protege a lista entre as threads
+        # o resultado é gravado em binário, de uma só vez, ou em texto
+        self._result_file = RESULT_BINARY if binary_output else RESULT_TEXT
+
     def run(self):
+        if self.sorts_locally():
+            self._sort_locally()
+        if self._local:  # não há líder nem workers a serem avisados
+            self._finish()
+            return
+
+        if self._direct:
+            self._start_fetch_server()
+
         while(self._num_list.is_unsorted()):
             try:
                 if not self._leader_addr:
                     self._connect_to_leader()
                 else:
-                    data = self._data_socket.recv(BUFFER_SIZE)
-                    if data:
-                        code = self._get_code_from(data)
-                        if code == '600':
-                            self._lists_recv_response()
-                        elif code == '700':
-                            self._lists_send_response(data)
-                    else:
-                        raise
+                    message, body = protocol.recv_message(self._data_socket)
+                    code = self._get_code_from(message)
+                    # os resultados diretos podem ter encerrado a iteração
+                    self._check_iteration()
+                    if code == '600':
+                        self._lists_recv_response(message)
+                    elif code == '650':
+                        self._lists_released(body)
+                    elif code == '700':
+                        self._lists_send_response(body)
             except:
                 self._disconnected_from_leader()
 
+        if not self._leader_addr:  # ordenada localmente
+            self._connect_to_leader()
         self._send_message_to_leader('500 All done')
+        self._close_leader_connection()
+        if self._fetch_socket:
+            self._stop_fetch_server()
+        self._finish()
+
+    def sorts_locally(self):
+        """Indica se a lista será ordenada sem tarefas para os workers"""
+
+        return self._local or self._num_list.size() <= self._local_size
+
+    def _close_leader_connection(self):
+        """
+        Fecha a conexão depois que o líder a fechar, descartando os
+        pedidos ainda não lidos, para que o fim do trabalho não seja
+        perdido em um reset da conexão
+        """
+
+        try:
+            self._data_socket.shutdown(socket.SHUT_WR)
+            self._data_socket.settimeout(1)
+            while self._data_socket.recv(BUFFER_SIZE):
+                pass
+        except OSError:
+            pass
         self._data_socket.close()
+
+    def _sort_locally(self):
+        """Ordena a lista inteira no próprio processo"""
+
+        self._print_log('Sorting locally')
+        self._num_list.sort_locally(merge.backend())
+
+    def _finish(self):
+        """Imprime o resultado e encerra o log"""
+
+        copies, wasted = self._num_list.stats()
+        self._print_log('Speculative copies: {}, wasted keys: {}'.format(
+            copies, wasted))
         self._print_results()
         self._print_log('Finished')
         if self._debug:
             self._file.close()
 
-    def _get_num_list(self, filename):
+    def _get_num_list(self, filename, binary=None):
         try:
-            file = open(filename, 'r')
+            return loader.load_keys(filename, binary, self._print_progress)
         except OSError:
             sys.stdout.write('Error: {} cannot be opened\n'.format(filename))
-        else:
-            num_list = file.readlines()
-            return list(map(int, num_list))
+
+    def _get_external(self, filename, directory, binary=None):
+        try:
+            return loader.load_external(filename, directory, binary,
+                                        self._print_progress)
+        except OSError:
+            sys.stdout.write('Error: {} cannot be opened\n'.format(filename))
+            return None, None
+
+    def _print_progress(self, done, total):
+        """Registra o carregamento do arquivo a cada décimo lido"""
+
+        loaded = done * 10 // total if total else 10
+        if loaded > self._loaded:
+            self._loaded = loaded
+            self._print_log('Loaded {}% of the input ({} bytes)'.format(
+                loaded * 10, done))
 
     def _find_leader_address(self):
         """
         Envia o pedido do endereço do líder.
         O pedido é da forma "100 <comentário>"
-        A resposta vem da forma "200 <comentário>"
+        A resposta vem da forma "200 <comentário> (porta dos workers,
+        porta do primeiro)"
         """
 
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -83,9 +194,12 @@ class first():
                 self._print_log('No response from Leader. Trying again...')
                 remaining_attempts -= 1
             else:
-                code = self._get_code_from(data)
+                resp = data.decode()
+                code = self._get_code_from(resp)
                 if code == '200':
                     self._leader_addr = addr[0]
+                    if '(' in resp:
+                        self._leader_port = int(self._get_values_from(resp)[1])
                     log = 'Leader found at: ({})'.format(self._leader_addr)
                     self._print_log(log)
                     break
@@ -94,6 +208,9 @@ class first():
     def _connect_to_leader(self):
         """Realiza a conexão de dados com o líder"""
 
+        if self._next_leader:  # endereço recebido do líder anterior
+            self._leader_addr, self._leader_port = self._next_leader
+            self._next_leader = None
         while not self._leader_addr:
             self._find_leader_address()
             if not self._leader_addr:
@@ -101,7 +218,9 @@ class first():
                 t = threading.Thread(target=leader_t, args=(self._debug,))
                 t.start()
         self._data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._data_socket.connect((self._leader_addr, F_DATA_PORT))
+        protocol.no_delay(self._data_socket)
+        self._data_socket.connect((self._leader_addr, self._leader_port))
+        self._passes_led = 0
         self._print_log('Connected to Leader ({})'.format(self._leader_addr))
 
     def _disconnected_from_leader(self):
@@ -111,81 +230,234 @@ class first():
         self._leader_addr = None
         self._data_socket.close()
 
-    def _lists_recv_response(self):
+    def _lists_recv_response(self, message):
         """
         Responde ao pedido de listas pelo líder.
-        O pedido vem da forma "600 <comentário>"
-        A resposta é da forma "700 <comentário> (send_size)"
+        O pedido vem da forma "600 <comentário> (n, bytes, chaves,
+        workers)"
+        A resposta é da forma "700 <comentário> (n)" seguida de um lote
+        de até n tarefas, limitado ao número de bytes pedido, com cerca
+        do número de chaves pedido em cada tarefa
         """
 
         # preparamos as listas a serem enviadas
-        index, a, b, num_iter = self._num_list.get_lists()
-        send_data = dict(index=index, a=a, b=b, num_iter=num_iter)
-        send_data = json.dumps(send_data)
-        send_size = len(send_data)
+        count, max_size, task_keys, workers = self._get_batch_from(message)
+        itemsize = array(KEY_TYPE).itemsize
+        with self._lock:
+            tasks = self._num_list.get_lists(
+                count, max_size // itemsize, task_keys, self._direct,
+                workers)
+            sort = self._num_list.is_sorting()
+        if self._direct:  # os workers buscam as listas pelos bilhetes
+            send_data = protocol.pack_batch(
+                [protocol.encode_ticket(index, lengths, num_iter, sort)
+                 for index, lengths, num_iter in tasks])
+            message = '700 Lists to merge ({}, {})'.format(
+                len(tasks), self._fetch_socket.getsockname()[1])
+        else:
+            send_data = protocol.pack_batch(
+                [protocol.encode_task(index, runs, num_iter, sort,
+                                      self._wire_format)
+                 for index, runs, num_iter in tasks])
+            message = '700 Lists to merge ({})'.format(len(tasks))
+
+        log = 'Sending {} lists to Leader ({})'.format(
+            len(tasks), self._leader_addr)
+        self._print_log(log)
+        self._send_message_to_leader(message, send_data)
 
-        try:
-            # envia o tamanho do buffer primeiro
-            message = '700 Request accepted. Send size: ({})'.format(send_size)
-            self._send_message_to_leader(message)
-
-            # espera a mensagem de pronto
-            data = self._data_socket.recv(BUFFER_SIZE)
-            if data:
-                code = self._get_code_from(data)
-                if code == '900':
-                    log = 'Sending lists to Leader ({})'.format(
-                        self._leader_addr)
-                    self._print_log(log)
-                    self._data_socket.sendall(send_data.encode())
-            else:  # se não receber os dados
-                raise
-        except:
-            raise
+    def _lists_send_response(self, body):
+        """
+        Responde ao pedido de envio das listas ordenadas.
+        O pedido vem da forma "700 <comentário> (n)" seguida de um lote
+        de listas ordenadas
+        A resposta é da forma "200 <comentário>"
+        """
+
+        log = 'Lists received from Leader ({})'.format(self._leader_addr)
+        self._print_log(log)
+        results = []
+        for result in protocol.unpack_batch(body):
+            data = protocol.decode_result(result)
+            results.append((data['index'], data['sorted'], data['num_iter']))
+        with self._lock:
+            self._num_list.set_lists(results)
 
-    def _lists_send_response(self, data):
+        self._check_iteration()
+        self._send_message_to_leader('200 Sorted List Received')
+
+    def _lists_released(self, body):
         """
-        Responde ao pedido de envio da lista ordenada.
-        O pedido vem da forma "700 <comentário> (send_size)"
-        A resposta é da forma "900 <comentário>"
+        Recebe as tarefas cujas concessões expiraram no líder, que são
+        reenviadas nos próximos lotes.
+        O pedido vem da forma "650 <comentário> (n)" seguido dos pares
+        (índice, iteração) das tarefas, sem resposta
         """
 
-        try:
-            # envia a resposta de aceite
-            self._send_message_to_leader('900 Ready to receive')
-
-            # recebe a lista ordenada
-            size = self._get_size_from(data)
-            data = self._data_socket.recv(size)
-            if data:
-                log = 'Lists received from Leader ({})'.format(
-                    self._leader_addr)
-                self._print_log(log)
-                data = json.loads(data.decode())
-                self._num_list.set_list(
-                    data['index'], data['sorted'], data['num_iter'])
-
-                # se mudou de iteração
-                if self._is_new_iter(data['num_iter']):
-                    self._change_leader()
-                    raise
-                else:
-                    self._send_message_to_leader('200 Sorted List Received')
-            else:
-                raise
-        except:
+        with self._lock:
+            for index, num_iter in protocol.unpack_leases(body):
+                self._num_list.release(index, num_iter)
+
+    def _check_iteration(self):
+        """
+        Se mudou de iteração, troca o líder conforme a política ou o
+        informa da nova iteração
+        """
+
+        with self._lock:
+            num_iter = self._num_list.num_iter()
+            unsorted = self._num_list.is_unsorted()
+        if num_iter == self._seen_iter:
+            return
+        self._seen_iter = num_iter
+        if not unsorted:  # a última iteração terminou
+            return
+        self._passes_led += 1
+        if self._leader_passes and self._passes_led >= self._leader_passes:
+            self._change_leader()
             raise
+        self._new_iteration()
 
-    def _is_new_iter(self, num_iter):
-        """Verifica se mudou de iteração"""
+    def _new_iteration(self):
+        """
+        Informa ao líder que permanece a nova iteração, para que descarte
+        as tarefas da anterior.
+        A mensagem é da forma "410 <comentário> (n)", sem resposta
+        """
 
-        return num_iter != self._num_list.num_iter() and self._num_list.is_unsorted()
+        message = '410 New iteration ({})'.format(self._num_list.num_iter())
+        self._send_message_to_leader(message)
 
     def _change_leader(self):
-        """Envia uma mensagem para iniciar a eleição de líder"""
+        """
+        Envia uma mensagem para iniciar a eleição de líder e espera pelo
+        endereço do novo líder.
+        O pedido é da forma "400 <comentário>"
+        A resposta vem da forma "320 <comentário> (endereço, porta)", ou
+        a conexão é fechada se não houver novo líder
+        """
 
         self._print_log('Initializing Leader Election')
         self._send_message_to_leader('400 Initialize Leader Election')
+        while True:
+            message, body = protocol.recv_message(self._data_socket)
+            if self._get_code_from(message) == '320':
+                host, port = self._get_values_from(message)
+                self._next_leader = (host, int(port))
+                break
+
+    def _start_fetch_server(self):
+        """
+        Inicia a thread com o laço de eventos que atende as conexões
+        diretas de todos os workers
+        """
+
+        self._fetch_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._fetch_socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self._fetch_socket.bind(('', F_FETCH_PORT))
+        except OSError:  # porta em uso, escolhemos uma livre
+            self._fetch_socket.bind(('', 0))
+        self._fetch_socket.listen(BACKLOG)
+        self._fetch_socket.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(
+            self._fetch_socket, selectors.EVENT_READ, self._fetch_socket)
+        t = threading.Thread(target=self._serve_workers)
+        t.daemon = True
+        t.start()
+
+    def _stop_fetch_server(self):
+        """Encerra o laço de eventos e fecha as conexões diretas"""
+
+        self._serving = False
+        self._fetch_thread_done.wait(SELECT_TIMEOUT * 2)
+
+    def _serve_workers(self):
+        """Laço de eventos: somente as conexões prontas são visitadas"""
+
+        while self._serving:
+            for key, mask in self._selector.select(SELECT_TIMEOUT):
+                if key.data is self._fetch_socket:
+                    self._accept_workers()
+                else:
+                    self._handle_worker(key.data, mask)
+
+        for key in list(self._selector.get_map().values()):
+            key.data.close()
+        self._selector.close()
+        self._fetch_thread_done.set()
+
+    def _accept_workers(self):
+        """Aceita as conexões diretas pendentes dos workers"""
+
+        while True:
+            try:
+                sock, addr = self._fetch_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            self._print_log('Worker connected ({})'.format(addr[0]))
+            conn = protocol.connection(sock, addr)
+            self._selector.register(conn, selectors.EVENT_READ, conn)
+
+    def _handle_worker(self, conn, mask):
+        """
+        Atende os pedidos diretos de um worker.
+        A busca vem da forma "800 <comentário>" seguida do bilhete
+        A resposta é da forma "700 <comentário>" seguida das listas, ou
+        "404 <comentário>" se a tarefa não está mais pendente
+        O envio vem da forma "700 <comentário>" seguido da lista
+        ordenada, sem resposta
+        """
+
+        try:
+            if mask & selectors.EVENT_WRITE:
+                conn.flush()
+            if mask & selectors.EVENT_READ:
+                for message, body in conn.recv_messages():
+                    code = message.split()[0]
+                    if code == '800':
+                        self._fetch_response(conn, body)
+                    elif code == '700':
+                        self._push_response(body)
+        except (OSError, ValueError, struct.error):
+            # conexão fechada ou dados inválidos: somente ela é encerrada
+            self._selector.unregister(conn)
+            conn.close(timeout=0)
+            return
+
+        # observa a escrita somente se houver dados pendentes
+        events = selectors.EVENT_READ
+        if conn.has_pending():
+            events |= selectors.EVENT_WRITE
+        if self._selector.get_key(conn).events != events:
+            self._selector.modify(conn, events, conn)
+
+    def _fetch_response(self, conn, ticket):
+        """Envia ao worker as listas da tarefa do bilhete"""
+
+        # somente a reserva e a cópia das listas são feitas sob a trava,
+        # a codificação é feita fora dela
+        index, num_iter, _ = protocol.payload_info(ticket)
+        with self._lock:
+            runs = self._num_list.get_runs(index, num_iter)
+            sort = self._num_list.is_sorting()
+        if runs is None:
+            conn.send_message('404 Task not found')
+        else:
+            task = protocol.encode_task(index, runs, num_iter, sort,
+                                        self._wire_format)
+            conn.send_message('700 Lists to merge', task)
+
+    def _push_response(self, body):
+        """Escreve o resultado entregue diretamente pelo worker"""
+
+        # a decodificação é feita fora da trava
+        data = protocol.decode_result(body)
+        with self._lock:
+            self._num_list.set_list(
+                data['index'], data['sorted'], data['num_iter'])
 
     def _create_leader(self):
         """Cria uma nova thread de líder"""
@@ -198,9 +470,7 @@ class first():
         """Imprime o resultado em um arquivo"""
 
         self._print_log('Printing Results')
-        with open('result.txt', 'w') as file:
-            for i in self._num_list._num_list:
-                file.write('{}\n'.format(i))
+        loader.save_keys(self._num_list._num_list, self._result_file)
 
     def _print_log(self, message):
         """Imprime uma mensagem de log com carimbo de tempo"""
@@ -213,26 +483,37 @@ class first():
 
         return datetime.datetime.now().strftime('%H:%M:%S:%f')
 
-    def _send_message_to_leader(self, message):
-        """Envia uma mensagem para o líder"""
+    def _send_message_to_leader(self, message, body=b''):
+        """Envia uma mensagem para o líder, com o payload opcional"""
 
         self._print_log('Message to Leader ({}): {}'.format(
             self._leader_addr, message))
-        self._data_socket.sendall(message.encode())
+        protocol.send_message(self._data_socket, message, body)
 
-    def _get_code_from(self, data):
-        """Extrai o código pela resposta do líder"""
+    def _get_batch_from(self, message):
+        """
+        Extrai o número de tarefas, de bytes e de chaves por tarefa
+        pedidos pelo líder e o número de workers conectados a ele
+        """
 
-        resp = data.decode()
-        log = 'Message from Leader ({}): {}'.format(self._leader_addr, resp)
-        self._print_log(log)
-        return resp.split()[0]
+        if '(' not in message:
+            return 1, 0, 0, 0
+        values = message[message.find('(')+1:message.find(')')].split(',')
+        values = [int(value) for value in values] + [0, 0]
+        return values[0], values[1], values[2], values[3]
 
-    def _get_size_from(self, data):
-        """Extrai o tamanho do buffer pela resposta do líder"""
+    def _get_values_from(self, message):
+        """Extrai os valores entre parênteses da mensagem"""
 
-        resp = data.decode()
-        return int(resp[resp.find('(')+1:resp.find(')')])
+        values = message[message.find('(')+1:message.find(')')].split(',')
+        return [value.strip() for value in values]
+
+    def _get_code_from(self, message):
+        """Extrai o código pela resposta do líder"""
+
+        log = 'Message from Leader ({}): {}'.format(self._leader_addr, message)
+        self._print_log(log)
+        return message.split()[0]
 
 
 def leader_t(debug):
@@ -1,24 +1,39 @@
 import threading
 import socket
+import protocol
 import json
 import sys
 import datetime
-import select
-import queue
+import selectors
 import operator
 import time
+from collections import deque
 
 BUFFER_SIZE = 4096   # tamanho do buffer de recebimento de dados
 LEADER_PORT = 30000  # porta de escuta para envio de endereço
 L_DATA_PORT = 40000  # porta de escuta para conexão de dados para os workers
 F_DATA_PORT = 50000  # porta de escuta para conexão de dados para o primeiro
+PREFETCH = 8         # tarefas buscadas antecipadamente do primeiro
+BATCH_BYTES = 1 << 20  # tamanho máximo de cada lote de tarefas pedido
+RESULT_BATCH = 16    # resultados agrupados em cada envio para o primeiro
+RESULT_DELAY = 0.05  # tempo máximo (s) de um resultado no lote
+BACKLOG = 1024       # conexões de workers aguardando aceitação
+TASK_TIME = 0.1      # duração desejada (s) de cada tarefa nos workers
+RATE_WEIGHT = 0.25   # peso de cada nova medida na média das vazões
+MIN_SAMPLE = 0.002   # execuções mais curtas (s) não medem a vazão
+RETRY_DELAY = 0.05   # espera (s) após um lote vazio do primeiro
+LEASE_TIME = 5.0     # duração mínima (s) da concessão de uma tarefa
+LEASE_FACTOR = 4     # concessão em múltiplos do tempo esperado da tarefa
+HEARTBEAT_TIMEOUT = 3.0  # silêncio (s) após o qual o worker é removido
+LEASE_CHECK = 0.5    # intervalo (s) entre as verificações das concessões
+ELECTION_TIMEOUT = 2.0  # espera (s) pela confirmação do novo líder
 
 
 class leader():
 
     """Classe responsável pela divisão dos trabalhos"""
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, state=None):
 
         # sockets para transmissão de endereço da conexão de dados
         self._conn_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -30,27 +45,53 @@ class leader():
         self._data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._data_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._data_socket.setblocking(0)
-        self._data_socket.bind(('', L_DATA_PORT))
-        self._data_socket.listen(10)
+        self._bind(self._data_socket, L_DATA_PORT)
+        self._data_socket.listen(BACKLOG)
 
         # socket de conexão de dados exclusivo com o primeiro computador
         self._fcom_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._fcom_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._fcom_socket.bind(('', F_DATA_PORT))
+        self._fcom_socket.setblocking(0)
+        self._bind(self._fcom_socket, F_DATA_PORT)
         self._fcom_socket.listen(1)
 
-        # estrutura de dados para gerenciamento de sockets
-        self._inputs = [self._conn_socket,
-                        self._data_socket, self._fcom_socket]
-        self._outputs = []
-        self._message_queues = {}  # fila das mensagens recebidas
-        self._sending_queues = {}  # fila para entrega dos dados
-        self._num_tasks_done = {}  # número de tarefas realizadas
-
-        self._fcom = None  # socket do primeiro computador
+        # laço de eventos: somente os sockets prontos são visitados
+        self._selector = selectors.DefaultSelector()
+        for s in (self._conn_socket, self._data_socket, self._fcom_socket):
+            self._selector.register(s, selectors.EVENT_READ, s)
+        self._num_tasks_done = {}  # número de tarefas realizadas por worker
+
+        # medidas dos workers para dimensionar as tarefas
+        # (worker, índice, iteração): (instante, chaves, fim da concessão)
+        self._dispatched = {}
+        self._held = {}  # chaves das tarefas concedidas a cada worker
+        self._last_seen = {}  # instante da última mensagem de cada worker
+        self._lease_check = 0  # instante da próxima verificação
+
+        # tabela de workers recebida do líder anterior: endereço ipv4
+        # com o número de tarefas realizadas e a vazão medida
+        self._inherited = {}
+        for addr, tasks_done, rate in (state or {}).get('workers', []):
+            self._inherited[addr] = (tasks_done, rate)
+        self._elected = None  # worker eleito aguardando confirmação
+        self._election_deadline = None  # fim da espera pelo eleito
+        self._last_done = {}  # instante do último resultado de cada worker
+        self._rates = {}  # média móvel das chaves processadas por segundo
+
+        # tarefas do primeiro computador ainda não entregues aos workers
+        self._ready_tasks = deque()
+        self._waiting_workers = deque()  # pedidos de tarefa dos workers
+        self._requested_tasks = 0  # tarefas pedidas e não recebidas
+        self._requested_batches = deque()  # tamanho dos lotes pedidos
+        self._results = []  # resultados a serem enviados em lote
+        self._buffered = set()  # (índice, iteração) dos resultados no lote
+        self._results_since = None  # instante do resultado mais antigo
+        self._retry_at = 0  # instante do próximo pedido após um lote vazio
+
+        self._fcom = None  # conexão com o primeiro computador
         self._undone = True  # trabalho não terminado
-        self._send_data = None  # dado a ser enviado
         self._first_addr = None  # endereço ipv4 do primeiro computador
+        self._fetch_addr = None  # endereço das buscas diretas no primeiro
         self._debug = debug
 
         if self._debug:
@@ -60,14 +101,15 @@ class leader():
     def run(self):
         while self._undone:
 
-            readable, writable, exceptional = select.select(
-                self._inputs, self._outputs, self._inputs)
+            events = self._selector.select(self._select_timeout())
 
             try:
-                self._handle_inputs(readable)
+                for key, mask in events:
+                    self._handle_event(key.data, mask)
+                self._check_workers()
                 if self._first_addr:  # somente com a conexão com o primeiro
-                    self._handle_outputs(writable)
-                    self._handle_conditions(exceptional)
+                    self._lists_send_request()
+                    self._lists_recv_request()
             except:
                 self._disconnected_from_first()
 
@@ -75,60 +117,83 @@ class leader():
         if self._debug:
             self._file.close()
 
-    def _handle_inputs(self, readable):
-        """Manipula sockets prontos para leitura"""
-
-        for s in readable:
-            if s is self._conn_socket:  # pedido de endereço
-                self._send_address()
-            elif s is self._data_socket:  # pedido de conexões dos workers
-                conn, addr = self._data_socket.accept()
-                self._print_log('Connected to Worker ({})'.format(addr[0]))
-                self._inputs.append(conn)
-                self._message_queues[conn] = queue.Queue()
-                self._sending_queues[conn] = queue.Queue()
-                self._num_tasks_done[conn] = 0
-            elif s is self._fcom_socket:  # pedido de conexão do primeiro
-                self._fcom, self._first_addr = self._fcom_socket.accept()
-                log = 'Connected to First ({})'.format(self._first_addr[0])
-                self._print_log(log)
-            else:  # comandos dos workers
-                data = s.recv(BUFFER_SIZE)
-                if data:
-                    self._message_queues[s].put(data)
-                    if s not in self._outputs:
-                        self._outputs.append(s)
-                else:  # conexão fechada, remover o socket do worker
-                    self._remove_worker(s)
-
-    def _handle_outputs(self, writable):
-        """Manipula sockets prontos para escrita"""
-
-        for s in writable:
+    def _handle_event(self, s, mask):
+        """Manipula um socket pronto para leitura ou escrita"""
+
+        if s is self._conn_socket:  # pedido de endereço
+            self._send_address()
+        elif s is self._data_socket:  # pedido de conexões dos workers
+            self._accept_worker()
+        elif s is self._fcom_socket:  # pedido de conexão do primeiro
+            self._accept_first()
+        elif s is self._fcom:  # mensagens do primeiro
+            if mask & selectors.EVENT_WRITE:
+                self._flush(s)
+            if mask & selectors.EVENT_READ:
+                for message, body in s.recv_messages():
+                    self._execute_response(message, body)
+        elif s in self._num_tasks_done:  # mensagens dos workers
+            self._handle_worker(s, mask)
+
+    def _accept_worker(self):
+        """Aceita as conexões pendentes dos workers"""
+
+        while True:
             try:
-                data = self._message_queues[s].get_nowait()
-            except queue.Empty:
-                self._outputs.remove(s)
+                sock, addr = self._data_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            self._print_log('Connected to Worker ({})'.format(addr[0]))
+            conn = protocol.connection(sock, addr)
+            self._selector.register(conn, selectors.EVENT_READ, conn)
+            self._num_tasks_done[conn] = 0
+            self._last_seen[conn] = time.monotonic()
+            if addr[0] in self._inherited:  # estatísticas do líder anterior
+                self._num_tasks_done[conn], rate = self._inherited[addr[0]]
+                if rate:
+                    self._rates[conn] = rate
+
+    def _accept_first(self):
+        """Aceita a conexão do primeiro computador"""
+
+        try:
+            sock, self._first_addr = self._fcom_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        self._fcom = protocol.connection(sock, self._first_addr)
+        self._selector.register(self._fcom, selectors.EVENT_READ, self._fcom)
+        log = 'Connected to First ({})'.format(self._first_addr[0])
+        self._print_log(log)
+        self._lists_recv_request()
+
+    def _handle_worker(self, s, mask):
+        """Lê as mensagens e envia os dados pendentes do worker s"""
+
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self._flush(s)
+            if mask & selectors.EVENT_READ:
+                messages = s.recv_messages()
             else:
-                code = self._get_code_from(data)
-                log = 'Message from Worker ({}): {}'.format(
-                    s.getpeername()[0], data.decode())
-                self._print_log(log)
-                if code == '600':
-                    self._task_recv_response(s)
-                elif code == '700':
-                    self._task_send_response(s, data)
-                elif code == '900':
-                    self._send_task(s)
-
-    def _handle_conditions(self, exceptional):
-        """Manipula sockets com condições excepcionais"""
-
-        for s in exceptional:
-            self._inputs.remove(s)
-            if s in self._outputs:
-                self._outputs.remove(s)
-            s.close()
+                messages = []
+        except OSError:  # conexão fechada, remover o socket do worker
+            self._remove_worker(s)
+            return
+        if messages:
+            self._last_seen[s] = time.monotonic()
+
+        for message, body in messages:
+            code = self._get_code_from(message)
+            log = 'Message from Worker ({}): {}'.format(s.addr[0], message)
+            self._print_log(log)
+            if code == '600':
+                self._task_recv_response(s)
+            elif code == '700':
+                self._task_send_response(s, message, body)
+            elif code == '710':
+                self._task_done_response(s, message)
+            elif code == '310' and s is self._elected:
+                self._handover(message)
 
     def _send_address(self):
         """
@@ -139,132 +204,347 @@ class leader():
         """
         data, addr = self._conn_socket.recvfrom(BUFFER_SIZE)
         if data:
-            code = self._get_code_from(data)
+            code = self._get_code_from(data.decode())
             if code == '100':
-                self._conn_socket.sendto('200 ok'.encode(), addr)
+                message = '200 ok ({}, {})'.format(*self.ports())
+                self._conn_socket.sendto(message.encode(), addr)
 
     def _task_recv_response(self, s):
         """
         Responde ao pedido de tarefa pelo worker.
         O pedido vem da forma "600 <comentário>"
-        A resposta é da forma "700 <comentário> (send_size)"
+        A resposta é da forma "700 <comentário>" seguida das listas
         """
-        #  recebe as listas do primeiro computador
+        #  o pedido é atendido pelas tarefas já buscadas do primeiro,
+        #  o worker pode ter várias tarefas pedidas antecipadamente
+        self._waiting_workers.append(s)
+        self._dispatch_tasks()
         self._lists_recv_request()
-        size = len(self._send_data)
-        try:
-            # envia o tamanho do buffer primeiro e depois a tarefa
-            message = '700 Request accepted. Send size: ({})'.format(size)
-            self._send_message_to_worker(message, s)
-            self._sending_queues[s].put(self._send_data)
-        except:
-            self._remove_worker(s)
 
-    def _task_send_response(self, s, data):
+    def _task_send_response(self, s, message, body):
         """
-        Responde ao pedido de envio da tarefa pronta para o Worker.
-        Recebe a tarefa pronta do worker e envia para o primeiro
-        O pedido vem da forma "700 <comentário> (send_size)"
-        A resposta é da forma "900 <comentário>"
+        Responde ao envio da tarefa pronta pelo Worker.
+        A tarefa pronta é agrupada para envio ao primeiro
+        O pedido vem da forma "700 <comentário> (segundos de execução)"
+        seguido da lista ordenada
+        A resposta é da forma "200 <comentário>"
         """
-        try:
-            # envia a resposta de aceite para o worker
-            self._send_message_to_worker('900 Ready to receive', s)
-
-            # recebe a tarefa pronta do worker
-            size = self._get_size_from(data)
-            self._send_data = s.recv(size)
-            log = 'Sorted list received from Worker ({})'.format(
-                s.getpeername()[0])
-            self._print_log(log)
+        log = 'Sorted list received from Worker ({})'.format(s.addr[0])
+        self._print_log(log)
 
-            if self._send_data:
-                # envia a lista ordenada para o primeiro
-                self._lists_send_request(self._send_data)
-                self._num_tasks_done[s] += 1
-            else:
-                raise
-        except:
-            self._remove_worker(s)
+        if not self._results:
+            self._results_since = time.monotonic()
+        self._results.append(body)
+        info = protocol.payload_info(body)
+        self._buffered.add(tuple(info[:2]))
+        self._num_tasks_done[s] += 1
+        elapsed = None
+        if '(' in message:
+            elapsed = float(message[message.find('(')+1:message.find(')')])
+        self._measure_task(s, info, elapsed)
+        self._send_message_to_worker('200 Sorted list received', s)
+
+    def _task_done_response(self, s, message):
+        """
+        Responde ao aviso de tarefa entregue diretamente ao primeiro.
+        O pedido vem da forma "710 <comentário> (índice, iteração, chaves,
+        segundos de execução)"
+        A resposta é da forma "200 <comentário>"
+        """
+        values = message[message.find('(')+1:message.find(')')].split(',')
+        self._num_tasks_done[s] += 1
+        elapsed = float(values[3]) if len(values) > 3 else None
+        self._measure_task(s, [int(value) for value in values[:3]], elapsed)
+        self._send_message_to_worker('200 Sorted list received', s)
 
-    def _send_task(self, s):
-        """Transfere os dados enfileirados para o socket s"""
-        try:
-            log = 'Sending task to Worker ({})'.format(s.getpeername()[0])
+    def _dispatch_tasks(self):
+        """
+        Entrega as tarefas prontas aos workers que as pediram. A cópia
+        de uma tarefa atrasada vai para um worker que não a possui, ou
+        é descartada se não houver nenhum esperando. A cópia de uma
+        tarefa cujo resultado está no lote é descartada, e o lote é
+        enviado para que o primeiro deixe de reenviá-la.
+        """
+
+        finished = False
+        while self._ready_tasks and self._waiting_workers:
+            task = self._ready_tasks.popleft()
+            index, num_iter, keys = protocol.payload_info(task)
+            if (index, num_iter) in self._buffered:
+                self._print_log('Dropping copy of done task {}'.format(index))
+                finished = True
+                continue
+            for s in self._waiting_workers:
+                if (s, index, num_iter) not in self._dispatched:
+                    break
+            else:
+                self._print_log('Dropping copy of task {}'.format(index))
+                continue
+            self._waiting_workers.remove(s)
+            log = 'Sending task to Worker ({})'.format(s.addr[0])
             self._print_log(log)
-            s.sendall(self._sending_queues[s].get())
-        except:
-            self._remove_worker(s)
+            now = time.monotonic()
+            self._dispatched[(s, index, num_iter)] = \
+                (now, keys, now + self._lease_time(s, keys))
+            self._held[s] = self._held.get(s, 0) + keys
+            message = '700 Lists to merge'
+            if self._fetch_addr:  # o worker busca as listas no primeiro
+                message += ' ({}, {})'.format(*self._fetch_addr)
+            self._send_message_to_worker(message, s, task)
+        if finished:
+            self._lists_send_request(force=True)
+
+    def _measure_task(self, s, info, elapsed=None):
+        """
+        Atualiza a vazão do worker s pelo tempo de execução da tarefa
+        informado pelo worker ou, sem ele, contado a partir do envio ou
+        do resultado anterior do worker. Execuções curtas demais são
+        dominadas pelo custo fixo da tarefa e não são medidas.
+        """
 
-    def _lists_recv_request(self):
+        index, num_iter, keys = info
+        dispatched = self._undispatch((s, index, num_iter))
+        if dispatched is None:  # tarefa entregue por outro líder
+            return
+        now = time.monotonic()
+        if elapsed is None:
+            elapsed = now - max(dispatched[0], self._last_done.get(s, 0))
+        self._last_done[s] = now
+        if elapsed < MIN_SAMPLE:
+            return
+        rate = dispatched[1] / elapsed
+        if s in self._rates:
+            rate = RATE_WEIGHT * rate + (1 - RATE_WEIGHT) * self._rates[s]
+        self._rates[s] = rate
+        log = 'Worker ({}) rate: {:.0f} keys/s, round trip: {:.3f}s'.format(
+            s.addr[0], rate, now - dispatched[0])
+        self._print_log(log)
+
+    def _lease_time(self, s, keys):
         """
-        Pedido de listas para o primeiro computador.
-        O pedido é da forma "600 <comentário>"
-        A resposta vem da forma "700 <comentário> (send_size)"
-        O retorno são os dados das listas
+        Duração da concessão de uma tarefa ao worker s, proporcional ao
+        tempo esperado para executar as tarefas que ele já possui
         """
 
-        try:
-            self._send_message_to_first('600 Give some lists')
-            self._execute_response()
-        except:
-            raise
+        if s not in self._rates:
+            return LEASE_TIME
+        held = self._held.get(s, 0)
+        return max(LEASE_TIME, LEASE_FACTOR * (held + keys) / self._rates[s])
+
+    def _undispatch(self, key):
+        """Encerra a concessão (worker, índice, iteração), se existir"""
 
-    def _lists_send_request(self, send_data):
+        dispatched = self._dispatched.pop(key, None)
+        if dispatched is not None:
+            self._held[key[0]] -= dispatched[1]
+        return dispatched
+
+    def _check_workers(self):
         """
-        Pedido de envio de lista ordenada para o primeiro computador.
-        O pedido é da forma "700 <comentário> (send_size)"
-        A resposta vem da forma "900 <comentário>"
+        Remove os workers silenciosos e devolve ao primeiro as tarefas
+        cujas concessões expiraram
         """
-        try:
-            send_size = len(send_data)
-            message = '700 Sending sorted list ({})'.format(send_size)
+
+        now = time.monotonic()
+        if now < self._lease_check:
+            return
+        self._lease_check = now + LEASE_CHECK
+
+        if self._election_deadline and now > self._election_deadline:
+            # sem confirmação, os workers procuram o novo líder sozinhos
+            self._print_log('New Leader did not answer')
+            self._close_all_connections()
+            return
+
+        for s, seen in list(self._last_seen.items()):
+            if now - seen > HEARTBEAT_TIMEOUT:
+                self._print_log('No heartbeat from Worker ({})'.format(
+                    s.addr[0]))
+                self._remove_worker(s)
+
+        expired = [key for key, value in self._dispatched.items()
+                   if value[2] < now]
+        for key in expired:
+            self._undispatch(key)
+        self._release_leases([key[1:] for key in expired])
+
+    def _release_leases(self, leases):
+        """
+        Devolve ao primeiro as tarefas das concessões expiradas.
+        O pedido é da forma "650 <comentário> (n)" seguido dos pares
+        (índice, iteração), sem resposta
+        """
+
+        if not leases or not self._first_addr:
+            return
+        message = '650 Expired leases ({})'.format(len(leases))
+        self._send_message_to_first(message, protocol.pack_leases(leases))
+
+    def _task_keys(self):
+        """Número de chaves por tarefa para que cada uma dure TASK_TIME"""
+
+        if not self._rates:
+            return 0  # sem medidas, o primeiro envia blocos isolados
+        rate = sum(self._rates.values()) / len(self._rates)
+        return int(rate * TASK_TIME)
+
+    def _lists_recv_request(self):
+        """
+        Pedido de um lote de listas para o primeiro computador, mantendo
+        tarefas prontas para os próximos pedidos dos workers.
+        O pedido é da forma "600 <comentário> (n, bytes, chaves, workers)"
+        A resposta vem da forma "700 <comentário> (n)" seguida das listas
+        """
+
+        if not self._first_addr or time.monotonic() < self._retry_at:
+            return
+        needed = len(self._waiting_workers) + PREFETCH
+        count = needed - self._requested_tasks - len(self._ready_tasks)
+        if count > 0:
+            message = '600 Give some lists ({}, {}, {}, {})'.format(
+                count, BATCH_BYTES, self._task_keys(),
+                len(self._num_tasks_done))
             self._send_message_to_first(message)
-            self._execute_response()
-        except:
-            raise
+            self._requested_tasks += count
+            self._requested_batches.append(count)
 
-    def _execute_response(self):
+    def _lists_send_request(self, force=False):
+        """
+        Envio das listas ordenadas para o primeiro computador em lotes,
+        quando o lote está cheio, o resultado mais antigo expirou ou o
+        envio é forçado.
+        O pedido é da forma "700 <comentário> (n)" seguido das listas
+        A resposta vem da forma "200 <comentário>"
+        """
+
+        if not self._results or not self._first_addr:
+            return
+        if len(self._results) < RESULT_BATCH and \
+                self._results_timeout() > 0 and not force:
+            return
+
+        log = 'Sending {} sorted lists to First ({})'.format(
+            len(self._results), self._first_addr[0])
+        self._print_log(log)
+        message = '700 Sending sorted lists ({})'.format(len(self._results))
+        self._send_message_to_first(
+            message, protocol.pack_batch(self._results))
+        self._results = []
+        self._buffered.clear()
+        self._results_since = None
+
+    def _select_timeout(self):
+        """Tempo até o próximo envio de resultados ou pedido de listas"""
+
+        timeouts = [self._results_timeout()]
+        now = time.monotonic()
+        if self._retry_at > now:
+            timeouts.append(self._retry_at - now)
+        if self._last_seen:  # verificação periódica das concessões
+            timeouts.append(max(0, self._lease_check - now))
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def _results_timeout(self):
+        """Tempo até o envio do lote de resultados pendente"""
+
+        if self._results_since is None:
+            return None
+        elapsed = time.monotonic() - self._results_since
+        return max(0, RESULT_DELAY - elapsed)
+
+    def _execute_response(self, message, body):
         """Executa a resposta do primeiro computador"""
 
-        data = self._fcom.recv(BUFFER_SIZE)
-        if data:
-            code = self._get_code_from(data)
-            log = 'Message from First ({}): {}'.format(
-                self._first_addr[0], data.decode())
-            self._print_log(log)
+        code = self._get_code_from(message)
+        log = 'Message from First ({}): {}'.format(
+            self._first_addr[0], message)
+        self._print_log(log)
 
-            if code == '400':  # eleição de líder
-                self._leader_election()
-                raise
-            elif code == '500':  # trabalho concluído
-                self._all_done()
-                raise
-            elif code == '700':  # pronto para receber os dados do primeiro
-                self._recv_list(data)
-            elif code == '900':  # pronto para enviar os dados para o primeiro
-                self._send_list()
-        else:
+        if code == '400':  # eleição de líder
+            self._leader_election()
+        elif code == '410':  # nova iteração com o mesmo líder
+            self._new_iteration(message)
+        elif code == '500':  # trabalho concluído
+            self._all_done()
             raise
+        elif code == '700':  # recebeu as listas do primeiro
+            tasks = protocol.unpack_batch(body)
+            values = message[message.find('(')+1:message.find(')')]
+            if ',' in values:  # bilhetes, com a porta das buscas diretas
+                port = int(values.split(',')[1])
+                self._fetch_addr = (self._first_addr[0], port)
+            log = '{} tasks received from First ({})'.format(
+                len(tasks), self._first_addr[0])
+            self._print_log(log)
+            self._requested_tasks -= self._requested_batches.popleft()
+            if not tasks:  # nada a entregar até que os resultados cheguem
+                self._retry_at = time.monotonic() + RETRY_DELAY
+            self._ready_tasks.extend(tasks)
+            self._dispatch_tasks()
+            self._lists_recv_request()
+
+    def _new_iteration(self, message):
+        """
+        Descarta as tarefas prontas e as concessões das iterações
+        anteriores, que não serão mais aceitas pelo primeiro
+        """
+
+        num_iter = int(message[message.find('(')+1:message.find(')')])
+        self._ready_tasks = deque(
+            task for task in self._ready_tasks
+            if protocol.payload_info(task)[1] >= num_iter)
+        for key in [key for key in self._dispatched if key[2] < num_iter]:
+            self._undispatch(key)
 
     def _leader_election(self):
         """
         Escolhe o worker que realizou mais tarefas e envia uma mensagem
-        informando que se tornou o líder da próxima iteração.
+        informando que se tornou o líder, com a tabela de workers.
+        A mensagem é da forma "300 <comentário>" seguida do estado
+        A resposta vem da forma "310 <comentário> (endereço, porta dos
+        workers, porta do primeiro)"
         """
-        try:
-            self._print_log('Initalizing Leader Election')
+        self._print_log('Initalizing Leader Election')
+        self._ready_tasks.clear()  # tarefas da iteração encerrada
+        while self._num_tasks_done:
             # escolhe o worker e envia a mensagem
             s = max(self._num_tasks_done.items(),
                     key=operator.itemgetter(1))[0]
-            self._send_message_to_worker('300 Become a Leader', s)
-        except:
-            self._remove_worker(s)
-            self._leader_election()
-        else:
-            log = 'New Leader Elected ({})'.format(s.getpeername()[0])
-            self._print_log(log)
-            self._close_all_connections()
+            try:
+                s.send_message('300 Become a Leader', self._get_state())
+            except OSError:
+                self._remove_worker(s)
+            else:
+                self._update_events(s)
+                log = 'New Leader Elected ({})'.format(s.addr[0])
+                self._print_log(log)
+                self._elected = s
+                self._election_deadline = time.monotonic() + ELECTION_TIMEOUT
+                return
+        self._close_all_connections()  # nenhum worker conectado
+
+    def _get_state(self):
+        """Codifica a tabela de workers e as vazões para o novo líder"""
+
+        workers = [[s.addr[0], tasks_done, self._rates.get(s, 0)]
+                   for s, tasks_done in self._num_tasks_done.items()]
+        return json.dumps(dict(workers=workers)).encode()
+
+    def _handover(self, message):
+        """
+        Informa o endereço do novo líder a todos os workers e ao primeiro
+        e fecha as conexões, depois que o novo líder já está escutando.
+        A mensagem é da forma "320 <comentário> (endereço, porta)"
+        """
+        values = message[message.find('(')+1:message.find(')')].split(',')
+        host, worker_port, first_port = [value.strip() for value in values]
+        self._print_log('New Leader listening at ({})'.format(host))
+        self._send_message_to_workers(
+            '320 New Leader ({}, {})'.format(host, worker_port))
+        self._send_message_to_first(
+            '320 New Leader ({}, {})'.format(host, first_port))
+        self._close_all_connections()
 
     def _all_done(self):
         """
@@ -277,84 +557,98 @@ class leader():
     def _send_message_to_workers(self, message):
         """Envia uma mensagem para todos os workers"""
 
-        workers = [
-            s for s in self._inputs if s is not self._conn_socket and s is not self._data_socket and s is not self._fcom_socket]
+        for s in list(self._num_tasks_done):
+            self._send_message_to_worker(message, s)
 
-        for s in workers:
-            try:
-                self._send_message_to_worker(message, s)
-            except:
-                self._remove_worker(s)
-        time.sleep(3)
+    def ports(self):
+        """Devolve as portas de escuta dos workers e do primeiro"""
+
+        return (self._data_socket.getsockname()[1],
+                self._fcom_socket.getsockname()[1])
+
+    def _bind(self, sock, port):
+        """
+        Associa o socket à porta padrão, ou a uma porta livre se o líder
+        anterior ainda a estiver usando
+        """
+
+        try:
+            sock.bind(('', port))
+        except OSError:
+            sock.bind(('', 0))
 
     def _close_all_connections(self):
         """Fecha todas as conexões"""
 
-        for s in self._inputs:
-            log = 'Closing connection ({})'.format(s.getpeername())
+        for s in list(self._num_tasks_done):
+            log = 'Closing connection ({})'.format(s.addr)
             self._print_log(log)
+            self._selector.unregister(s)
             s.close()
+        self._num_tasks_done.clear()
 
-        message = 'Closing connection to First ({})'.format(
-            self._first_addr[0])
-        self._print_log(message)
-        self._fcom.close()
-        self._first_addr = None
-        self._undone = False
-
-    def _recv_list(self, data):
-        """Recebe os dados das listas do primeiro computador"""
-        try:
-            # envia a mensagem de pronto
-            self._send_message_to_first('900 Ready to receive')
-
-            # recebe os dados
-            size = self._get_size_from(data)
-            data = self._fcom.recv(size)
-            if data:
-                self._send_data = data
-                log = 'Task received from First ({})'.format(
-                    self._first_addr[0])
-                self._print_log(log)
-            else:
-                raise
-        except:
-            raise
-
-    def _send_list(self):
-        """Envia os dados da lista ordenada para o primeiro computador"""
+        for s in (self._conn_socket, self._data_socket, self._fcom_socket):
+            self._selector.unregister(s)
+            s.close()
 
-        try:
-            log = 'Sending sorted list to First ({})'.format(
+        if self._first_addr:
+            message = 'Closing connection to First ({})'.format(
                 self._first_addr[0])
-            self._print_log(log)
-            self._fcom.sendall(self._send_data)
-            self._execute_response()
-        except:
-            self._disconnected_from_first()
+            self._print_log(message)
+            self._selector.unregister(self._fcom)
+            self._fcom.close()
+            self._first_addr = None
+        self._selector.close()
+        self._undone = False
 
     def _disconnected_from_first(self):
         """Procedimentos no caso de desconexão com o primeiro computador"""
 
-        log = 'Disconnected from First ({})'.format(self._first_addr[0])
-        self._print_log(log)
-        self._fcom.close()
-        self._first_addr = None
-        self._undone = False
+        if self._undone:
+            if self._first_addr:
+                log = 'Disconnected from First ({})'.format(
+                    self._first_addr[0])
+                self._print_log(log)
+            self._close_all_connections()
 
     def _remove_worker(self, s):
-        """Remove o socket do worker"""
+        """Remove a conexão do worker"""
 
-        log = 'Removing disconnected Worker ({})'.format(s.getpeername())
+        if s not in self._num_tasks_done:  # já removido
+            return
+        log = 'Removing disconnected Worker ({})'.format(s.addr)
         self._print_log(log)
 
-        self._inputs.remove(s)
-        del self._message_queues[s]
-        del self._sending_queues[s]
         del self._num_tasks_done[s]
-        if s in self._outputs:
-            self._outputs.remove(s)
-        s.close()
+        self._waiting_workers = deque(
+            w for w in self._waiting_workers if w is not s)
+        self._rates.pop(s, None)
+        self._last_done.pop(s, None)
+        self._last_seen.pop(s, None)
+        held = [key for key in self._dispatched if key[0] is s]
+        for key in held:
+            del self._dispatched[key]
+        self._held.pop(s, None)
+        self._release_leases([key[1:] for key in held])
+        self._selector.unregister(s)
+        s.close(timeout=0)
+        if s is self._elected:  # o eleito caiu antes de confirmar
+            self._close_all_connections()
+
+    def _flush(self, s):
+        """Envia os dados pendentes e atualiza o interesse de escrita"""
+
+        s.flush()
+        self._update_events(s)
+
+    def _update_events(self, s):
+        """Observa a escrita do socket somente se houver dados pendentes"""
+
+        events = selectors.EVENT_READ
+        if s.has_pending():
+            events |= selectors.EVENT_WRITE
+        if self._selector.get_key(s).events != events:
+            self._selector.modify(s, events, s)
 
     def _print_log(self, message):
         """Imprime uma mensagem de log com carimbo de tempo"""
@@ -367,32 +661,32 @@ class leader():
 
         return datetime.datetime.now().strftime('%H:%M:%S:%f')
 
-    def _send_message_to_first(self, message):
+    def _send_message_to_first(self, message, body=b''):
         """Envia uma mensagem para o primeiro computador"""
 
         log = 'Message to First ({}): {}'.format(self._first_addr[0], message)
         self._print_log(log)
-        self._fcom.sendall(message.encode())
+        self._fcom.send_message(message, body)
+        self._update_events(self._fcom)
 
-    def _send_message_to_worker(self, message, s):
+    def _send_message_to_worker(self, message, s, body=b''):
         """Envia uma mensagem para o Worker s"""
 
-        log = 'Message to Worker ({}): {}'.format(s.getpeername()[0], message)
+        if s not in self._num_tasks_done:  # já removido
+            return
+        log = 'Message to Worker ({}): {}'.format(s.addr[0], message)
         self._print_log(log)
-        s.sendall(message.encode())
+        try:
+            s.send_message(message, body)
+        except OSError:
+            self._remove_worker(s)
+        else:
+            self._update_events(s)
 
-    def _get_code_from(self, data):
+    def _get_code_from(self, message):
         """Extrai o código pela mensagem de resposta"""
 
-        resp = data.decode()
-        return resp.split()[0]
-
-    def _get_size_from(self, data):
-        """Extrai o tamanho do buffer pela mensagem de resposta"""
-
-        resp = data.decode()
-        size = int(resp[resp.find('(')+1:resp.find(')')])
-        return max(size, BUFFER_SIZE)
+        return message.split()[0]
 
 
 if __name__ == "__main__":
@@ -1,62 +1,403 @@
+from collections import deque, OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right
+from protocol import KEY_TYPE
+import time
+
+MAX_COPIES = 2        # envios de uma tarefa antes de considerá-la perdida
+LATENCY_QUANTILE = 0.9  # tarefas mais antigas que este quantil são reenviadas
+LATENCY_SAMPLES = 256  # latências recentes usadas no cálculo do quantil
+RESEND_AGE = 1.0      # idade (s) para reenvio antes de haver latências
+RESEND_FACTOR = 2     # tarefas reenviadas após este múltiplo do quantil
+MIN_RESEND_AGE = 0.25  # idade mínima (s) para reenvio, acima dos lotes do
+                       # líder e da espera das tarefas antecipadas
+STALL_AGE = 10.0      # idade (s) a partir da qual a tarefa é dada por perdida
+EXTERNAL_RUN = 1 << 20  # chaves na memória por vez com dois buffers
+
+
 class list_manager():
 
-    def __init__(self, num_list):
-        self._num_list = num_list  # a lista de números
+    def __init__(self, num_list, run_size=1, fan_in=2, split_size=None,
+                 spare=None):
+        # a lista de números (array de chaves ou arquivo binário mapeado)
+        self._num_list = num_list
+        # com um segundo buffer do mesmo tamanho, as listas são lidas de
+        # um e os resultados escritos no outro, trocados a cada iteração
+        self._spare = spare
         self._list_size = len(num_list)  # tamanho da lista
-        # status: 0 (não enviado), 1 (enviado), 2 (recebido)
-        self._status = [0] * self._list_size
-        self._send_size = 1  # tamanho de cada lista de envio
+        self._send_size = run_size  # tamanho de cada lista de envio
+        self._fan_in = fan_in  # número de listas intercaladas por tarefa
+        # intercalações maiores são divididas em partes deste tamanho;
+        # com dois buffers, as tarefas nunca passam de EXTERNAL_RUN chaves
+        if spare is not None:
+            split_size = min(split_size or EXTERNAL_RUN, EXTERNAL_RUN)
+        self._split_size = split_size
+        # com blocos maiores que 1, a iteração 0 ordena os blocos localmente
+        self._sorting = run_size > 1
         self._iter = 0  # iteração atual
+        self._copies_sent = 0  # reenvios especulativos de tarefas
+        self._wasted_keys = 0  # chaves de resultados descartados
+        self._reset_blocks()
+
+    def _reset_blocks(self):
+        """reinicia a contabilidade dos blocos da iteração atual"""
+
+        # na fase de ordenação cada bloco é uma única lista desordenada
+        fan_in = 1 if self._sorting else self._fan_in
+        self._block_size = fan_in * self._send_size  # elementos por bloco
+        self._num_blocks = -(-self._list_size // self._block_size)
+        # os blocos são enviados em ordem: os ainda não enviados são os
+        # a partir deste, sem uma entrada por bloco na memória
+        self._next_block = 0
+        # tarefas enviadas e ainda não recebidas, pelo índice de escrita,
+        # com o número de blocos da tarefa (0 para partes de um bloco)
+        self._in_flight = OrderedDict()
+        self._done = 0  # número de blocos recebidos
+        # partes de blocos divididos: listas de entrada de cada parte (ou
+        # os seus intervalos, com dois buffers), partes ainda não enviadas,
+        # bloco de cada parte e partes restantes
+        self._parts = {}
+        self._pending_parts = deque()
+        self._part_block = {}
+        self._parts_left = {}
+        # instantes do primeiro e do último envio e número de envios de
+        # cada tarefa, e latências das tarefas recebidas na iteração
+        self._first_sent = {}
+        self._last_sent = {}
+        self._copies = {}
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._released = deque()  # tarefas devolvidas pelo líder
+
+    def get_lists(self, count=1, max_keys=None, task_keys=None,
+                  tickets=False, workers=None):
+        """
+        devolve até count tarefas, cada uma com o índice, as listas
+        ordenadas e o número da iteração, limitadas a max_keys chaves
+        (ao menos uma tarefa é devolvida, se houver). Blocos consecutivos
+        são agrupados em uma só tarefa até task_keys chaves (no máximo a
+        parte de cada um dos workers e split_size) e blocos maiores são
+        divididos em partes. As tarefas devolvidas são reenviadas
+        primeiro e, sem blocos novos, somente as tarefas atrasadas são
+        reenviadas. Com tickets, as tarefas trazem somente os tamanhos
+        das listas, que são buscadas depois por get_runs.
+        """
+        if task_keys and workers:  # todos os workers recebem tarefas
+            task_keys = min(task_keys, -(-self._list_size // workers))
+        tasks = []
+        keys = 0
+        stragglers = self._stragglers()
+        while len(tasks) < count:
+            if self._released:
+                index = self._released.popleft()
+                if index not in self._in_flight:  # já recebida
+                    continue
+                self._resend(index)
+            elif self._has_pending() or self._pending_parts:
+                index = self._get_block(task_keys)
+            else:
+                index = next(stragglers, None)
+                if index is None:
+                    break
+                self._resend(index)
+            if tickets:
+                runs = self._get_lengths(index)
+                keys += sum(runs)
+            else:
+                runs = self._get_runs(index)
+                keys += sum(len(run) for run in runs)
+            tasks.append((index, runs, self._iter))
+            if max_keys is not None and keys >= max_keys:
+                break
+        return tasks
+
+    def _get_block(self, task_keys=None):
+        """marca a próxima tarefa nova como enviada e devolve o seu índice"""
+        # as partes têm o menor dos tamanhos definidos
+        sizes = [size for size in (task_keys, self._split_size) if size]
+        part_size = min(sizes) if sizes else None
+        if not self._pending_parts and self._has_pending() and part_size \
+                and not self._sorting and self._block_size >= 2 * part_size:
+            # o bloco é grande demais para uma só tarefa
+            self._split_block(self._next_block, part_size)
+            self._next_block += 1
+
+        if self._pending_parts:
+            # buscamos por partes de blocos divididos ainda não enviadas
+            index = self._pending_parts.popleft()
+            self._in_flight[index] = 0
+        elif self._has_pending():
+            # buscamos por blocos ainda não enviados, agrupando os blocos
+            # consecutivos até o tamanho das partes
+            block = self._next_block
+            num_blocks = 1
+            while block + num_blocks < self._num_blocks and task_keys and \
+                    (num_blocks + 1) * self._block_size <= part_size:
+                num_blocks += 1
+            self._next_block = block + num_blocks
+            index = block * self._block_size
+            self._in_flight[index] = num_blocks
+        now = time.monotonic()
+        self._first_sent[index] = self._last_sent[index] = now
+        self._copies[index] = 1
+        return index
+
+    def _has_pending(self):
+        """indica se há blocos da iteração ainda não enviados"""
+        return self._next_block < self._num_blocks
+
+    def release(self, index, num_iter):
+        """
+        devolve a tarefa cuja concessão expirou no líder, para que seja
+        reenviada antes dos próximos blocos
+        """
+        if num_iter == self._iter and index in self._in_flight and \
+                index not in self._released:
+            self._released.append(index)
+
+    def _stragglers(self):
+        """
+        percorre as tarefas enviadas da mais antiga para a mais nova e
+        devolve as atrasadas que ainda podem ser reenviadas. Uma tarefa
+        está atrasada se passou bem do quantil das latências, que já
+        inclui a espera nos lotes e na fila do líder.
+        """
+        if self._latencies:
+            latencies = sorted(self._latencies)
+            limit = latencies[int(LATENCY_QUANTILE * (len(latencies) - 1))]
+            limit = max(MIN_RESEND_AGE, RESEND_FACTOR * limit)
+        else:
+            limit = RESEND_AGE
+        now = time.monotonic()
+        # a ordem do dicionário é a do último envio de cada tarefa
+        for index in list(self._in_flight):
+            age = now - self._last_sent[index]
+            if age <= limit:
+                break
+            if self._copies[index] < MAX_COPIES or age > STALL_AGE:
+                yield index
+
+    def _resend(self, index):
+        """reenvia a tarefa atrasada que escreve a partir de index"""
+        self._in_flight.move_to_end(index)
+        self._last_sent[index] = time.monotonic()
+        self._copies[index] += 1
+        self._copies_sent += 1
+
+    def get_runs(self, index, num_iter):
+        """
+        devolve as listas da tarefa enviada que escreve a partir de index,
+        ou None se ela não está mais pendente
+        """
+        if num_iter != self._iter or index not in self._in_flight:
+            return None
+        return self._get_runs(index)
+
+    def _get_runs(self, index):
+        """prepara as listas da tarefa que escreve a partir de index"""
+        if index in self._parts and self._spare is None:
+            return self._parts[index]
+        return [self._copy(start, end)
+                for start, end in self._get_bounds(index)]
+
+    def _copy(self, start, end):
+        """copia um trecho da lista de números para um array de chaves"""
+        keys = self._num_list[start:end]
+        if isinstance(keys, memoryview):  # arquivo mapeado na memória
+            copy = array(KEY_TYPE)
+            copy.frombytes(keys.cast('B'))
+            return copy
+        return keys
 
-    def get_lists(self):
-        """devolve o índice e duas listas ordenadas e o número da iteração"""
-        try:
-            # buscamos por blocos ainda não enviados
-            index = self._status.index(0)
-        except ValueError:
-            # buscamos por blocos ainda não recebidos e enviamos novamente
-            index = self._status.index(1)
-
-        # preparamos duas listas
-        start, finish = index, index + self._send_size
-        a = self._num_list[start:finish]
-        start, finish = index + self._send_size, index + 2 * self._send_size
-        b = self._num_list[start:finish]
-
-        # marcamos os elementos como enviado
-        start = index
-        finish = self._list_size \
-            if self._list_size < index + 2 * self._send_size \
-            else index + 2 * self._send_size
-
-        for i in range(start, finish):
-            self._status[i] = 1
-        return index, a, b, self._iter
+    def _get_lengths(self, index):
+        """devolve os tamanhos das listas da tarefa, sem copiá-las"""
+        if index in self._parts and self._spare is None:
+            return [len(run) for run in self._parts[index]]
+        return [end - start for start, end in self._get_bounds(index)]
+
+    def _get_bounds(self, index):
+        """devolve os intervalos das listas da tarefa na lista de números"""
+        if index in self._parts:  # somente com dois buffers
+            return self._parts[index]
+        # na fase de ordenação os blocos consecutivos formam uma única
+        # lista desordenada
+        num_blocks = self._in_flight[index]
+        finish = min(index + num_blocks * self._block_size, self._list_size)
+        if self._sorting:
+            return [(index, finish)]
+        return [(start, min(start + self._send_size, finish))
+                for start in range(index, finish, self._send_size)]
+
+    def _split_block(self, block, part_size):
+        """
+        divide a intercalação do bloco em partes independentes, cujas
+        saídas são intervalos disjuntos do bloco (merge path)
+        """
+        index = block * self._block_size
+        finish = min(index + self._block_size, self._list_size)
+        starts = range(index, finish, self._send_size)
+        if self._spare is None:
+            runs = [self._copy(start, min(start + self._send_size, finish))
+                    for start in starts]
+        else:  # a entrada não é sobrescrita, a busca é feita sem cópias
+            runs = [self._num_list[start:min(start + self._send_size, finish)]
+                    for start in starts]
+        num_parts = -(-(finish - index) // part_size)
+        ranks = [(finish - index) * i // num_parts
+                 for i in range(num_parts + 1)]
+
+        # as partes guardam cópias das entradas, pois as saídas das outras
+        # partes sobrescrevem o bloco antes que todas sejam intercaladas;
+        # com dois buffers basta guardar os intervalos
+        splits = [split_runs(runs, rank) for rank in ranks]
+        for i in range(num_parts):
+            part = index + ranks[i]
+            if self._spare is None:
+                self._parts[part] = [run[lo:hi] for run, lo, hi
+                                     in zip(runs, splits[i], splits[i + 1])]
+            else:
+                self._parts[part] = [
+                    (start + lo, start + hi) for start, lo, hi
+                    in zip(starts, splits[i], splits[i + 1])]
+            self._part_block[part] = block
+            self._pending_parts.append(part)
+        self._parts_left[block] = num_parts
+
+    def set_lists(self, results):
+        """recebe um lote de (índice, lista ordenada, número da iteração)"""
+        for index, sorted, num_iter in results:
+            self.set_list(index, sorted, num_iter)
 
     def set_list(self, index, sorted, num_iter):
         """recebe o índice do início da escrita,
         a lista ordenada e número da iteração"""
 
-        # escrevemos os blocos na mesma iteração e se ainda não foi escrito
-        if num_iter == self._iter and self._status[index] == 1:
+        # escrevemos as tarefas na mesma iteração e se ainda não foi escrita
+        if num_iter == self._iter and index in self._in_flight:
 
-            # marcamos os elementos como recebido
-            for i in range(index, index + len(sorted)):
-                self._status[i] = 2
+            # marcamos os blocos da tarefa como recebidos
+            num_blocks = self._in_flight.pop(index)
+            self._latencies.append(
+                time.monotonic() - self._first_sent.pop(index))
+            del self._last_sent[index]
+            del self._copies[index]
+            if index in self._parts:
+                # o bloco dividido é recebido com a sua última parte
+                del self._parts[index]
+                block = self._part_block.pop(index)
+                self._parts_left[block] -= 1
+                if not self._parts_left[block]:
+                    del self._parts_left[block]
+                    num_blocks = 1
+            self._done += num_blocks
 
-            # atualizamos a lista com os elementos ordenados
-            for i in range(len(sorted)):
-                self._num_list[index+i] = sorted[i]
+            # atualizamos a lista com os elementos ordenados; a intercalação
+            # de blocos consecutivos mantém cada bloco ordenado
+            if not isinstance(sorted, array) or sorted.typecode != KEY_TYPE:
+                sorted = array(KEY_TYPE, sorted)
+            target = self._num_list if self._spare is None else self._spare
+            target[index:index + len(sorted)] = sorted
 
-            # se todos os elementos foram ordenados, subimos de iteração,
-            # dobramos o tamanho do envio e reiniciamos o status
-            if min(self._status) == 2:
+            # se todos os blocos foram ordenados, subimos de iteração,
+            # multiplicamos o tamanho do envio e reiniciamos os blocos
+            if self._done == self._num_blocks:
                 self._iter += 1
-                self._send_size *= 2
-                self._status = [0] * self._list_size
+                if self._sorting:  # os blocos ordenados iniciam a intercalação
+                    self._sorting = False
+                else:
+                    self._send_size *= self._fan_in
+                if self._spare is not None:  # os resultados são a entrada
+                    self._num_list, self._spare = self._spare, self._num_list
+                self._reset_blocks()
+        else:
+            # resultado de uma cópia já recebida ou de uma iteração passada
+            self._wasted_keys += len(sorted)
+
+    def sort_locally(self, engine):
+        """ordena a lista inteira com o motor dado e encerra as iterações"""
+        if self._spare is None:
+            self._num_list[:] = engine.sort_run(self._num_list)
+        else:
+            self._sort_external(engine)
+        self._sorting = False
+        self._send_size = max(self._list_size, 1)
+        self._iter += 1
+        self._reset_blocks()
+
+    def _sort_external(self, engine):
+        """
+        ordena entre os dois buffers sem carregar a lista inteira: os
+        blocos de EXTERNAL_RUN chaves são ordenados e depois intercalados
+        fan_in a fan_in, em partes de EXTERNAL_RUN chaves divididas como
+        em _split_block, alternando os buffers a cada passagem
+        """
+        size = self._list_size
+        for start in range(0, size, EXTERNAL_RUN):
+            end = min(start + EXTERNAL_RUN, size)
+            self._spare[start:end] = engine.sort_run(self._num_list[start:end])
+        self._num_list, self._spare = self._spare, self._num_list
+
+        run_size = EXTERNAL_RUN
+        while run_size < size:
+            block_size = run_size * self._fan_in
+            for index in range(0, size, block_size):
+                finish = min(index + block_size, size)
+                runs = [self._num_list[start:min(start + run_size, finish)]
+                        for start in range(index, finish, run_size)]
+                ranks = list(range(0, finish - index, EXTERNAL_RUN))
+                splits = [split_runs(runs, rank)
+                          for rank in ranks + [finish - index]]
+                for i, rank in enumerate(ranks):
+                    merged = engine.merge_runs(
+                        [run[lo:hi] for run, lo, hi
+                         in zip(runs, splits[i], splits[i + 1])])
+                    start = index + rank
+                    self._spare[start:start + len(merged)] = merged
+            self._num_list, self._spare = self._spare, self._num_list
+            run_size = block_size
+
+    def stats(self):
+        """devolve o número de reenvios e de chaves descartadas"""
+        return self._copies_sent, self._wasted_keys
+
+    def size(self):
+        return self._list_size
+
+    def is_sorting(self):
+        """verifica se a iteração atual é a de ordenação dos blocos"""
+        return self._sorting
 
     def is_unsorted(self):
-        return self._send_size < self._list_size
+        return self._num_blocks > 0 and \
+            (self._sorting or self._send_size < self._list_size)
 
     def num_iter(self):
         return self._iter
+
+
+def split_runs(runs, rank):
+    """
+    devolve, para cada lista ordenada, quantos elementos dela estão entre
+    os rank menores de todas as listas; os empates são atribuídos às
+    primeiras listas, para que as divisões sejam crescentes com rank
+    """
+    if rank <= 0:
+        return [0] * len(runs)
+
+    # busca binária pelo menor valor v com ao menos rank elementos <= v
+    lo = min(run[0] for run in runs if run)
+    hi = max(run[-1] for run in runs if run)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if sum(bisect_right(run, mid) for run in runs) >= rank:
+            hi = mid
+        else:
+            lo = mid + 1
+
+    # todos os menores que v entram, os iguais a v completam o rank
+    splits = [bisect_left(run, lo) for run in runs]
+    needed = rank - sum(splits)
+    for i, run in enumerate(runs):
+        taken = min(needed, bisect_right(run, lo) - splits[i])
+        splits[i] += taken
+        needed -= taken
+    return splits
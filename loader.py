@@ -0,0 +1,160 @@
+from array import array
+from protocol import KEY_TYPE
+import shutil
+import mmap
+import sys
+import os
+
+CHUNK_SIZE = 1 << 20  # bytes lidos do arquivo texto de cada vez
+BINARY_SUFFIX = '.bin'  # extensão dos arquivos de inteiros binários
+WRITE_KEYS = 1 << 16  # chaves formatadas de cada vez na saída em texto
+WRITE_BUFFER = 1 << 20  # buffer (bytes) do arquivo de saída em texto
+
+
+def load_keys(filename, binary=None, progress=None):
+    """
+    Carrega as chaves do arquivo, um inteiro por linha ou inteiros de
+    32 bits sem sinal em little-endian (binary, ou extensão .bin).
+    progress é chamada com os bytes já lidos e o total do arquivo.
+    """
+
+    if binary is None:
+        binary = filename.endswith(BINARY_SUFFIX)
+    if binary:
+        return _load_binary(filename, progress)
+    return _load_text(filename, progress)
+
+
+def _load_text(filename, progress):
+    """
+    Interpreta o texto em blocos de tamanho fixo, direto no array de
+    chaves, sem guardar as linhas do arquivo inteiro
+    """
+
+    keys = array(KEY_TYPE)
+    for chunk in _parse_text(filename, progress):
+        keys.extend(chunk)
+    return keys
+
+
+def _parse_text(filename, progress):
+    """gera as chaves do arquivo texto em pedaços, um por bloco lido"""
+    total = os.path.getsize(filename)
+    done = 0
+    rest = b''
+    with open(filename, 'rb') as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            done += len(chunk)
+            # o último número pode estar incompleto no fim do bloco
+            end = chunk.rfind(b'\n') + 1
+            if end:
+                yield map(int, (rest + chunk[:end]).split())
+                rest = chunk[end:]
+            else:
+                rest += chunk
+            if progress:
+                progress(done, total)
+    if rest.strip():
+        yield map(int, rest.split())
+
+
+def _load_binary(filename, progress):
+    """
+    Mapeia o arquivo binário na memória, sem interpretá-lo; as escritas
+    da ordenação ficam na cópia privada do processo
+    """
+
+    total = os.path.getsize(filename)
+    itemsize = array(KEY_TYPE).itemsize
+    if total % 4:
+        raise ValueError('{} is not a list of 32-bit keys'.format(filename))
+    if not total:
+        return array(KEY_TYPE)
+    with open(filename, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    if itemsize == 4 and sys.byteorder == 'little':
+        keys = memoryview(data).cast(KEY_TYPE)
+    else:  # o formato do arquivo difere do array de chaves
+        words = array('I' if array('I').itemsize == 4 else 'L')
+        words.frombytes(data)
+        if sys.byteorder == 'big':
+            words.byteswap()
+        keys = array(KEY_TYPE, words)
+    if progress:
+        progress(total, total)
+    return keys
+
+
+def save_keys(keys, filename, binary=None):
+    """
+    Grava as chaves no arquivo, no mesmo formato lido por load_keys: em
+    texto, formatadas em lotes; em binário, o buffer inteiro de uma vez
+    """
+
+    if binary is None:
+        binary = filename.endswith(BINARY_SUFFIX)
+    if binary:
+        _save_binary(keys, filename)
+        return
+    with open(filename, 'w', buffering=WRITE_BUFFER) as file:
+        for start in range(0, len(keys), WRITE_KEYS):
+            file.write('\n'.join(map(str, keys[start:start + WRITE_KEYS])))
+            file.write('\n')
+
+
+def _save_binary(keys, filename):
+    """escreve as chaves como inteiros de 32 bits sem sinal, little-endian"""
+    if array(KEY_TYPE).itemsize != 4 or sys.byteorder != 'little':
+        words = array('I' if array('I').itemsize == 4 else 'L', keys)
+        if sys.byteorder == 'big':
+            words.byteswap()
+        keys = words
+    with open(filename, 'wb', buffering=0) as file:
+        data = memoryview(keys).cast('B')
+        while data:  # a escrita sem buffer pode ser parcial
+            data = data[file.write(data):]
+
+
+def load_external(filename, directory, binary=None, progress=None):
+    """
+    Converte as chaves para dois arquivos binários em directory (keys.0 e
+    keys.1) e devolve os dois mapeados na memória, de modo que a ordenação
+    alterne entre eles sem manter as chaves na memória do processo.
+    Lança ValueError se o array de chaves não tiver o formato do arquivo.
+    """
+
+    if array(KEY_TYPE).itemsize != 4 or sys.byteorder != 'little':
+        raise ValueError('external sort needs 32-bit little-endian keys')
+    if binary is None:
+        binary = filename.endswith(BINARY_SUFFIX)
+    os.makedirs(directory, exist_ok=True)
+    names = [os.path.join(directory, 'keys.{}'.format(i)) for i in (0, 1)]
+
+    with open(names[0], 'wb') as output:
+        if binary:
+            total = os.path.getsize(filename)
+            if total % 4:
+                raise ValueError(
+                    '{} is not a list of 32-bit keys'.format(filename))
+            with open(filename, 'rb') as file:
+                shutil.copyfileobj(file, output, CHUNK_SIZE)
+            if progress:
+                progress(total, total)
+        else:
+            for chunk in _parse_text(filename, progress):
+                output.write(array(KEY_TYPE, chunk).tobytes())
+        size = output.tell()
+    with open(names[1], 'wb') as output:
+        output.truncate(size)
+
+    if not size:  # não é possível mapear arquivos vazios
+        return array(KEY_TYPE), array(KEY_TYPE)
+    buffers = []
+    for name in names:
+        with open(name, 'r+b') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE)
+        buffers.append(memoryview(data).cast(KEY_TYPE))
+    return tuple(buffers)
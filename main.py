@@ -1,44 +1,111 @@
-from worker import worker
+from worker import worker, WINDOW
 from leader import leader
-from first import first
-import sys
+from first import first, RUN_SIZE, FAN_IN, LOCAL_SIZE, SPLIT_SIZE, \
+    LEADER_PASSES
+from protocol import BINARY, JSON
+import merge
+import argparse
 import threading
 
 
-def worker_t(debug):
-    wo = worker(debug)
+def worker_t(debug, options):
+    wo = worker(debug, options.window, options.processes,
+                options.merge_backend)
     wo.run()
 
 
-def leader_t(debug):
-    lo = leader(debug)
+def leader_t(lo):
     lo.run()
 
 
-def first_t(filename, debug):
-    fo = first(filename, debug)
+def first_t(filename, debug, options):
+    fo = first(filename, debug,
+               run_size=options.run_size, fan_in=options.fan_in,
+               wire_format=JSON if options.json else BINARY,
+               local=options.local, local_size=options.local_size,
+               split_size=options.split_size,
+               leader_passes=0 if options.persistent_leader
+               else options.leader_passes,
+               direct=options.direct,
+               binary_input=options.binary_input or None,
+               external=options.external,
+               binary_output=options.binary_output)
+    # a lista pequena é ordenada no próprio primeiro: o worker local não
+    # teria tarefas e poderia perder o aviso de fim procurando o líder
+    threads = []
+    if not fo.sorts_locally():
+        threads.append(threading.Thread(target=worker_t,
+                                        args=(debug, options)))
+    for t in threads:
+        t.start()
     fo.run()
+    for t in threads:
+        t.join()
 
 
-# primeiro computador sem debug ou qualquer computador com debug
-if len(sys.argv) > 1:
-    if sys.argv[1].lower() == 'debug':  # qualquer computador com debug
-        w_t = threading.Thread(target=worker_t, args=(True,))
-        w_t.start()
-    elif len(sys.argv) > 2:  # primeiro computador com debug
-        f_t = threading.Thread(target=first_t, args=(sys.argv[1], True))
-        f_t.start()
-        l_t = threading.Thread(target=leader_t, args=(True,))
-        l_t.start()
-        w_t = threading.Thread(target=worker_t, args=(True,))
-        w_t.start()
-    else:  # primeiro computador sem debug
-        f_t = threading.Thread(target=first_t, args=(sys.argv[1], False))
-        f_t.start()
-        l_t = threading.Thread(target=leader_t, args=(False,))
-        l_t.start()
-        w_t = threading.Thread(target=worker_t, args=(False,))
-        w_t.start()
-else:   # qualquer computador exceto o primeiro sem debug
-    w_t = threading.Thread(target=worker_t, args=(False,))
-    w_t.start()
+def parse_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('args', nargs='*', help='[arquivo] [debug]')
+    parser.add_argument('--run-size', type=int, default=RUN_SIZE,
+                        help='tamanho dos blocos ordenados localmente')
+    parser.add_argument('--fan-in', type=int, default=FAN_IN,
+                        help='número de listas intercaladas por tarefa')
+    parser.add_argument('--json', action='store_true',
+                        help='envia as tarefas em JSON (depuração)')
+    parser.add_argument('--window', type=int, default=WINDOW,
+                        help='tarefas pedidas antecipadamente por executor')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='processos executores de intercalação no nó')
+    parser.add_argument('--merge-backend', choices=(merge.PYTHON, merge.NUMPY),
+                        help='motor de intercalação (padrão: o mais rápido)')
+    parser.add_argument('--local', action='store_true',
+                        help='ordena no próprio processo, sem líder e workers')
+    parser.add_argument('--local-size', type=int, default=LOCAL_SIZE,
+                        help='listas até este tamanho são ordenadas localmente')
+    parser.add_argument('--split-size', type=int, default=SPLIT_SIZE,
+                        help='intercalações maiores são divididas em partes')
+    parser.add_argument('--leader-passes', type=int, default=LEADER_PASSES,
+                        help='iterações conduzidas por cada líder eleito')
+    parser.add_argument('--persistent-leader', action='store_true',
+                        help='mantém o líder até que ele falhe')
+    parser.add_argument('--direct', action='store_true',
+                        help='workers buscam e entregam as listas no primeiro')
+    parser.add_argument('--binary-input', action='store_true',
+                        help='o arquivo tem inteiros de 32 bits (padrão: .bin)')
+    parser.add_argument('--external', metavar='DIR',
+                        help='ordena em dois arquivos mapeados nesse diretório')
+    parser.add_argument('--binary-output', action='store_true',
+                        help='grava o resultado em result.bin, 32 bits por chave')
+    return parser.parse_args()
+
+
+# o código abaixo não roda nos processos executores dos workers
+if __name__ == "__main__":
+    options = parse_options()
+    argv = options.args
+    threads = []
+
+    # primeiro computador sem debug ou qualquer computador com debug
+    if len(argv) > 0:
+        if argv[0].lower() == 'debug':  # qualquer computador com debug
+            threads.append(threading.Thread(target=worker_t,
+                                            args=(True, options)))
+        else:  # primeiro computador, com debug se houver o segundo argumento
+            debug = len(argv) > 1
+            threads.append(threading.Thread(target=first_t,
+                                            args=(argv[0], debug, options)))
+            if not options.local:  # o worker local é iniciado pelo primeiro
+                # o líder é criado antes das threads para que as portas já
+                # estejam abertas quando o primeiro o procurar
+                threads.append(threading.Thread(target=leader_t,
+                                                args=(leader(debug),)))
+    else:   # qualquer computador exceto o primeiro sem debug
+        threads.append(threading.Thread(target=worker_t,
+                                        args=(False, options)))
+
+    for t in threads:
+        t.start()
+    # a thread principal espera as demais para que os executores de
+    # processos continuem aceitando tarefas
+    for t in threads:
+        t.join()
@@ -0,0 +1,87 @@
+from array import array
+from protocol import KEY_TYPE
+
+try:
+    import numpy
+except ImportError:  # o numpy é opcional
+    numpy = None
+
+PYTHON = 'python'  # ordenação do próprio python (timsort)
+NUMPY = 'numpy'    # ordenação vetorizada do numpy
+
+
+class python_backend():
+
+    """Ordena e intercala com o timsort, que aproveita as listas já ordenadas"""
+
+    name = PYTHON
+
+    def sort_run(self, run):
+        """recebe uma lista desordenada e devolve a lista ordenada"""
+        return array(KEY_TYPE, sorted(run))
+
+    def merge_runs(self, runs):
+        """recebe listas ordenadas e devolve a intercalação destas"""
+        if len(runs) == 1:
+            return array(KEY_TYPE, runs[0])
+        merged = array(KEY_TYPE)
+        for run in runs:
+            merged.extend(run)
+        # o timsort detecta as listas ordenadas e apenas as intercala
+        return array(KEY_TYPE, sorted(merged))
+
+
+class numpy_backend():
+
+    """Ordena e intercala sobre os buffers dos arrays, sem laços em python"""
+
+    name = NUMPY
+
+    def __init__(self):
+        self._dtype = numpy.dtype('u{}'.format(array(KEY_TYPE).itemsize))
+
+    def sort_run(self, run):
+        """recebe uma lista desordenada e devolve a lista ordenada"""
+        keys = self._as_numpy(run).copy()
+        keys.sort()
+        return self._as_keys(keys)
+
+    def merge_runs(self, runs):
+        """recebe listas ordenadas e devolve a intercalação destas"""
+        if len(runs) == 1:
+            return array(KEY_TYPE, runs[0])
+        keys = numpy.concatenate([self._as_numpy(run) for run in runs])
+        # a ordenação estável do numpy é um radix/timsort que aproveita
+        # as listas já ordenadas
+        keys.sort(kind='stable')
+        return self._as_keys(keys)
+
+    def _as_numpy(self, run):
+        """vê o array de chaves como um vetor do numpy, sem cópia"""
+        if isinstance(run, (array, memoryview)) and \
+                run.itemsize == self._dtype.itemsize:
+            return numpy.frombuffer(run, dtype=self._dtype)
+        return numpy.fromiter(run, dtype=self._dtype, count=len(run))
+
+    def _as_keys(self, keys):
+        """converte o vetor do numpy de volta para um array de chaves"""
+        result = array(KEY_TYPE)
+        result.frombytes(keys.tobytes())
+        return result
+
+
+def backend(name=None):
+    """
+    Devolve o motor de ordenação pedido, ou o mais rápido disponível.
+    Lança ValueError se o motor pedido não estiver disponível.
+    """
+
+    if name is None:
+        name = NUMPY if numpy is not None else PYTHON
+    if name == PYTHON:
+        return python_backend()
+    if name == NUMPY:
+        if numpy is None:
+            raise ValueError('numpy is not installed')
+        return numpy_backend()
+    raise ValueError('unknown merge backend: {}'.format(name))
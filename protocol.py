@@ -0,0 +1,413 @@
+from array import array
+from collections import deque
+import socket
+import struct
+import json
+import sys
+
+# tipo das chaves: inteiros sem sinal de pelo menos 32 bits
+KEY_TYPE = 'I' if array('I').itemsize >= 4 else 'L'
+
+BINARY = 'binary'  # formato binário das tarefas
+JSON = 'json'      # formato texto, mantido para depuração
+
+TASK = b'T'    # tipo do payload de tarefa
+RESULT = b'R'  # tipo do payload de resultado
+
+SORT_FLAG = 0x01  # a tarefa é a ordenação de um bloco inicial
+TICKET_FLAG = 0x02  # somente o cabeçalho, as listas são buscadas no primeiro
+
+# cabeçalho: tipo, flags, tamanho da chave em bytes, número de listas,
+# número da iteração e índice de escrita, seguido pelos tamanhos das
+# listas (uint64) e pelas chaves, tudo em little-endian
+HEADER = struct.Struct('<cBBxIIQ')
+LENGTH = struct.Struct('<Q')
+
+# prefixo de tamanho de cada quadro enviado pelas conexões TCP
+FRAME = struct.Struct('<Q')
+SMALL_BODY = 1 << 16  # payloads copiados junto com o cabeçalho do quadro
+
+# concessão devolvida ao primeiro: índice de escrita e número da iteração
+LEASE = struct.Struct('<QI')
+
+
+def encode_task(index, runs, num_iter, sort=False, fmt=BINARY):
+    """Codifica uma tarefa com as listas a serem intercaladas"""
+
+    if fmt == JSON:
+        return json.dumps(dict(index=index,
+                               runs=[list(run) for run in runs],
+                               num_iter=num_iter, sort=sort)).encode()
+    flags = SORT_FLAG if sort else 0
+    return _encode(TASK, flags, index, runs, num_iter)
+
+
+def encode_result(index, sorted, num_iter, fmt=BINARY):
+    """Codifica o resultado de uma tarefa"""
+
+    if fmt == JSON:
+        return json.dumps(dict(index=index, sorted=list(sorted),
+                               num_iter=num_iter)).encode()
+    return _encode(RESULT, 0, index, [sorted], num_iter)
+
+
+def encode_ticket(index, lengths, num_iter, sort=False):
+    """
+    Codifica o bilhete de uma tarefa: o cabeçalho e os tamanhos das
+    listas, que são buscadas pelo worker diretamente no primeiro
+    """
+
+    flags = TICKET_FLAG | (SORT_FLAG if sort else 0)
+    itemsize = array(KEY_TYPE).itemsize
+    parts = [HEADER.pack(TASK, flags, itemsize, len(lengths), num_iter, index)]
+    parts.extend(LENGTH.pack(length) for length in lengths)
+    return b''.join(parts)
+
+
+def decode_task(data):
+    """
+    Decodifica uma tarefa em um dicionário com as chaves
+    index, runs, num_iter, sort e format
+    """
+
+    if _is_json(data):
+        d = json.loads(bytes(data).decode())
+        d.setdefault('sort', False)
+        d['format'] = JSON
+        return d
+    flags, index, runs, num_iter = _decode(TASK, data)
+    return dict(index=index, runs=runs, num_iter=num_iter,
+                sort=bool(flags & SORT_FLAG), format=BINARY)
+
+
+def decode_result(data):
+    """
+    Decodifica um resultado em um dicionário com as chaves
+    index, sorted, num_iter e format
+    """
+
+    if _is_json(data):
+        d = json.loads(bytes(data).decode())
+        d['format'] = JSON
+        return d
+    flags, index, runs, num_iter = _decode(RESULT, data)
+    return dict(index=index, sorted=runs[0], num_iter=num_iter,
+                format=BINARY)
+
+
+def payload_info(data):
+    """
+    Devolve o índice, o número da iteração e o número de chaves de uma
+    tarefa ou resultado, lendo somente o cabeçalho quando binário
+    """
+
+    if _is_json(data):
+        d = json.loads(bytes(data).decode())
+        runs = d['runs'] if 'runs' in d else [d['sorted']]
+        return d['index'], d['num_iter'], sum(len(run) for run in runs)
+    code, flags, itemsize, num_runs, num_iter, index = \
+        HEADER.unpack_from(data)
+    if flags & TICKET_FLAG:
+        lengths = data[HEADER.size:HEADER.size + num_runs * LENGTH.size]
+        keys = sum(length for length, in LENGTH.iter_unpack(lengths))
+    else:
+        keys = (len(data) - HEADER.size - num_runs * LENGTH.size) // itemsize
+    return index, num_iter, keys
+
+
+def pack_batch(payloads):
+    """Concatena vários payloads, cada um precedido pelo seu tamanho"""
+
+    parts = []
+    for payload in payloads:
+        parts.append(LENGTH.pack(len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def unpack_batch(data):
+    """Separa os payloads de um lote sem copiar os dados"""
+
+    view = memoryview(data)
+    payloads = []
+    offset = 0
+    while offset < len(view):
+        size, = LENGTH.unpack_from(view, offset)
+        offset += LENGTH.size
+        payloads.append(view[offset:offset + size])
+        offset += size
+    return payloads
+
+
+def pack_leases(leases):
+    """Codifica os pares (índice, iteração) das concessões expiradas"""
+
+    return b''.join(LEASE.pack(index, num_iter) for index, num_iter in leases)
+
+
+def unpack_leases(data):
+    """Decodifica os pares (índice, iteração) das concessões expiradas"""
+
+    return list(LEASE.iter_unpack(data))
+
+
+def _is_json(data):
+    return bytes(data[:1]) == b'{'
+
+
+def _encode(kind, flags, index, runs, num_iter):
+    """Monta o cabeçalho e concatena as listas em binário"""
+
+    runs = [_as_keys(run) for run in runs]
+    itemsize = array(KEY_TYPE).itemsize
+    parts = [HEADER.pack(kind, flags, itemsize, len(runs), num_iter, index)]
+    parts.extend(LENGTH.pack(len(run)) for run in runs)
+    for run in runs:
+        if sys.byteorder == 'big':
+            run = array(run.typecode, run)
+            run.byteswap()
+        parts.append(run.tobytes())
+    return b''.join(parts)
+
+
+def _decode(kind, data):
+    """Lê o cabeçalho e as listas diretamente do buffer recebido"""
+
+    view = memoryview(data)
+    code, flags, itemsize, num_runs, num_iter, index = \
+        HEADER.unpack_from(view)
+    if code != kind:
+        raise ValueError('unexpected payload type: {}'.format(code))
+    offset = HEADER.size
+    lengths = []
+    for _ in range(num_runs):
+        lengths.append(LENGTH.unpack_from(view, offset)[0])
+        offset += LENGTH.size
+
+    typecode = _typecode_for(itemsize)
+    runs = []
+    for length in lengths:
+        finish = offset + length * itemsize
+        if finish > len(view):
+            raise ValueError('truncated payload')
+        run = array(typecode)
+        run.frombytes(view[offset:finish])
+        if sys.byteorder == 'big':
+            run.byteswap()
+        runs.append(run)
+        offset = finish
+    return flags, index, runs, num_iter
+
+
+def _as_keys(run):
+    """Converte a lista para um array de chaves, se necessário"""
+
+    if isinstance(run, array):
+        return run if run.typecode == KEY_TYPE else array(KEY_TYPE, run)
+    return array(KEY_TYPE, run)
+
+
+def _typecode_for(itemsize):
+    """Devolve o tipo de array sem sinal com o tamanho de chave dado"""
+
+    for typecode in (KEY_TYPE, 'I', 'L', 'Q'):
+        if array(typecode).itemsize == itemsize:
+            return typecode
+    raise ValueError('unsupported key size: {}'.format(itemsize))
+
+
+def no_delay(sock):
+    """
+    Desativa o algoritmo de Nagle no socket, para que uma mensagem não
+    espere a confirmação da anterior, e o devolve
+    """
+
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def connect(addr, timeout=None):
+    """
+    Abre uma conexão TCP com o endereço dado, sem o atraso de Nagle e
+    com o tempo máximo (s) de cada operação, se dado
+    """
+
+    return no_delay(socket.create_connection(addr, timeout))
+
+
+def send_message(sock, message, body=b''):
+    """Envia a mensagem de controle e o payload em um único quadro"""
+
+    header = message.encode() + b'\n'
+    sock.sendall(b''.join((FRAME.pack(len(header) + len(body)),
+                           header, body)))
+
+
+def recv_message(sock):
+    """Recebe um quadro e devolve a mensagem de controle e o payload"""
+
+    return split_message(recv_frame(sock))
+
+
+def split_message(frame):
+    """Separa a mensagem de controle do payload sem copiar os dados"""
+
+    end = frame.find(b'\n')
+    if end < 0:
+        end = len(frame)
+    return bytes(frame[:end]).decode(), memoryview(frame)[end + 1:]
+
+
+def recv_frame(sock):
+    """Recebe um quadro completo, independente do seu tamanho"""
+
+    size, = FRAME.unpack(recv_exact(sock, FRAME.size))
+    return recv_exact(sock, size)
+
+
+def recv_exact(sock, size):
+    """Recebe exatamente size bytes em um buffer pré-alocado"""
+
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if not count:
+            raise ConnectionError('connection closed by peer')
+        received += count
+    return buffer
+
+
+class connection():
+
+    """
+    Conexão TCP não bloqueante que troca mensagens em quadros de
+    tamanho prefixado, usada pelos laços de eventos
+    """
+
+    CHUNK_SIZE = 1 << 16  # tamanho do buffer de leitura reutilizado
+
+    def __init__(self, sock, addr=None):
+        sock.setblocking(False)
+        no_delay(sock)
+        self.sock = sock
+        self.addr = addr  # endereço do par remoto
+        self._chunk = bytearray(self.CHUNK_SIZE)
+        self._header = bytearray()  # prefixo do quadro sendo recebido
+        self._frame = None  # quadro sendo recebido
+        self._received = 0  # bytes já recebidos do quadro
+        self._outgoing = deque()  # buffers ainda não enviados
+        self._closed = False  # o par remoto fechou a conexão
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv_messages(self):
+        """
+        Lê os dados disponíveis e devolve as mensagens completas como
+        pares (mensagem, payload). Lança ConnectionError se a conexão
+        foi fechada pelo par remoto.
+        """
+
+        if self._closed:
+            raise ConnectionError('connection closed by peer')
+        messages = []
+        while True:
+            try:
+                missing = len(self._frame) - self._received \
+                    if self._frame is not None else 0
+                if missing >= self.CHUNK_SIZE:
+                    # quadros grandes são lidos direto no buffer final
+                    view = memoryview(self._frame)[self._received:]
+                    count = self.sock.recv_into(view)
+                    self._received += count
+                    self._complete_frame(messages)
+                else:
+                    count = self.sock.recv_into(self._chunk)
+                    self._feed(memoryview(self._chunk)[:count], messages)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not count:
+                # as mensagens já recebidas são entregues antes do erro
+                self._closed = True
+                if not messages:
+                    raise ConnectionError('connection closed by peer')
+                break
+        return messages
+
+    def send_message(self, message, body=b''):
+        """Enfileira uma mensagem e envia o que for possível"""
+
+        header = message.encode() + b'\n'
+        frame = FRAME.pack(len(header) + len(body)) + header
+        # payloads pequenos vão no mesmo envio do cabeçalho, os grandes
+        # são enviados sem cópia
+        if len(body) <= SMALL_BODY:
+            self._outgoing.append(frame + bytes(body))
+        else:
+            self._outgoing.append(frame)
+            self._outgoing.append(memoryview(body))
+        return self.flush()
+
+    def flush(self):
+        """Envia os dados pendentes, devolve True se não restou nada"""
+
+        while self._outgoing:
+            data = self._outgoing[0]
+            try:
+                sent = self.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                return False
+            if sent < len(data):
+                self._outgoing[0] = memoryview(data)[sent:]
+                return False
+            self._outgoing.popleft()
+        return True
+
+    def has_pending(self):
+        """Verifica se ainda há dados a serem enviados"""
+
+        return bool(self._outgoing)
+
+    def close(self, timeout=1):
+        """Tenta entregar os dados pendentes e fecha a conexão"""
+
+        try:
+            if self._outgoing:
+                self.sock.settimeout(timeout)
+                for data in self._outgoing:
+                    self.sock.sendall(data)
+        except OSError:
+            pass
+        self._outgoing.clear()
+        self.sock.close()
+
+    def _feed(self, view, messages):
+        """Distribui os bytes lidos entre o prefixo e o corpo dos quadros"""
+
+        while len(view):
+            if self._frame is None:
+                needed = FRAME.size - len(self._header)
+                self._header += view[:needed]
+                view = view[needed:]
+                if len(self._header) == FRAME.size:
+                    size, = FRAME.unpack(self._header)
+                    self._header = bytearray()
+                    self._frame = bytearray(size)
+                    self._received = 0
+                    self._complete_frame(messages)
+            else:
+                taken = min(len(view), len(self._frame) - self._received)
+                self._frame[self._received:self._received + taken] = \
+                    view[:taken]
+                self._received += taken
+                view = view[taken:]
+                self._complete_frame(messages)
+
+    def _complete_frame(self, messages):
+        """Entrega o quadro atual se ele já foi completamente recebido"""
+
+        if self._frame is not None and self._received == len(self._frame):
+            messages.append(split_message(self._frame))
+            self._frame = None
@@ -1,7 +1,13 @@
 from leader import leader
 import threading
-import socket
 import json
+import socket
+import protocol
+import merge
+import queue
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import sys
 import datetime
 import time
@@ -9,22 +15,42 @@ import time
 BUFFER_SIZE = 4096   # tamanho do buffer de recebimento de dados
 LEADER_PORT = 30000  # porta de escuta para envio de endereço
 L_DATA_PORT = 40000  # porta de escuta para conexão de dados para os workers
+WINDOW = 2           # tarefas pedidas ou em execução por executor
+HEARTBEAT = 1.0      # intervalo (s) entre os sinais de vida para o líder
+FETCH_TIMEOUT = 10.0  # espera máxima (s) pelas listas buscadas no primeiro
 
 
 class worker():
 
     """classe responsável pela execução do trabalho"""
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, window=WINDOW, processes=1,
+                 backend=None):
 
         self._leader_addr = None  # endereço ipv4 do líder
+        self._leader_port = L_DATA_PORT  # porta de dados do líder
+        self._next_leader = None  # endereço e porta informados no repasse
         self._undone = True  # trabalho não terminado
-        self._send_data = None  # dado a ser enviado para o líder
+        # com vários processos, pedimos tarefas proporcionalmente
+        self._window = window * processes  # máximo de tarefas pendentes
+        self._outstanding = 0  # tarefas pedidas ou em execução
+        self._lock = threading.RLock()  # protege a janela de tarefas
+        self._generation = 0  # conexão atual com o líder
+        self._sending_queue = None  # mensagens a serem enviadas ao líder
+        self._fetch_sockets = {}  # conexões diretas de busca no primeiro
+        # executores de intercalação, um processo por núcleo; os processos
+        # são iniciados do zero para não herdarem os sockets do líder
+        self._pool = ProcessPoolExecutor(
+            processes, multiprocessing.get_context('spawn')) \
+            if processes > 1 else None
+        # motor de ordenação e intercalação usado nas tarefas
+        self._backend = merge.backend(backend).name
         self._debug = debug
 
         if self._debug:
             self._file = open('worker_log_{}.txt'.format(
                 datetime.datetime.now().strftime('%H_%M_%S')), 'w')
+        self._print_log('Merge backend: {}'.format(self._backend))
 
     def run(self):
         while self._undone:
@@ -33,9 +59,13 @@ class worker():
                     self._connect_to_leader()
                 else:
                     self._task_recv_request()
-                    self._task_send_request()
+                    self._execute_response()
             except:
                 self._disconnected_from_leader()
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
+        for sock in self._fetch_sockets.values():
+            sock.close()
         self._print_log('Finished')
         if self._debug:
             self._file.close()
@@ -44,7 +74,8 @@ class worker():
         """
         Envia o pedido do endereço do líder.
         O pedido é da forma "100 <comentário>"
-        A resposta vem da forma "200 <comentário>"
+        A resposta vem da forma "200 <comentário> (porta dos workers,
+        porta do primeiro)"
         """
 
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -69,6 +100,8 @@ class worker():
                 code = resp.split()[0]
                 if code == '200':
                     self._leader_addr = addr[0]
+                    if '(' in resp:
+                        self._leader_port = int(self._get_values_from(resp)[0])
                     log = 'Leader found at: ({})'.format(self._leader_addr)
                     self._print_log(log)
                     break
@@ -79,13 +112,20 @@ class worker():
     def _connect_to_leader(self):
         """Realiza a conexão de dados com o líder"""
 
-        self._find_leader_address()
+        if self._next_leader:  # endereço recebido do líder anterior
+            self._leader_addr, self._leader_port = self._next_leader
+            self._next_leader = None
+        else:
+            self._find_leader_address()
         if self._leader_addr:
             self._data_socket = socket.socket(
                 socket.AF_INET, socket.SOCK_STREAM)
             self._data_socket.setsockopt(
                 socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self._data_socket.connect((self._leader_addr, L_DATA_PORT))
+            protocol.no_delay(self._data_socket)
+            self._data_socket.connect(
+                (self._leader_addr, self._leader_port))
+            self._start_sending()
 
             log = 'Connected to Leader ({})'.format(self._leader_addr)
             self._print_log(log)
@@ -95,131 +135,227 @@ class worker():
 
         self._print_log('Disconnected from ({})'.format(self._leader_addr))
         self._leader_addr = None
+        # os resultados que terminarem até a reconexão são descartados
+        with self._lock:
+            self._generation += 1
+            if self._sending_queue:
+                self._sending_queue.put(None)  # encerra a thread de envio
+                self._sending_queue = None
         self._data_socket.close()
 
+    def _start_sending(self):
+        """
+        Inicia a thread que envia as mensagens para o líder, para que
+        os resultados sejam entregues enquanto as próximas tarefas são
+        recebidas e executadas
+        """
+
+        with self._lock:
+            self._outstanding = 0
+            self._generation += 1
+            self._sending_queue = queue.Queue()
+        t = threading.Thread(target=self._send_messages,
+                             args=(self._data_socket, self._sending_queue))
+        t.daemon = True
+        t.start()
+        t = threading.Thread(target=self._send_heartbeats,
+                             args=(self._sending_queue,))
+        t.daemon = True
+        t.start()
+
+    def _send_messages(self, sock, sending_queue):
+        """
+        Envia as mensagens enfileiradas até o fim da conexão; os
+        resultados com o endereço do primeiro são entregues diretamente
+        """
+
+        push_sockets = {}  # conexões diretas de envio ao primeiro
+        while True:
+            item = sending_queue.get()
+            if item is None:
+                break
+            try:
+                if len(item) == 4:
+                    self._push_result(sock, push_sockets, *item)
+                else:
+                    protocol.send_message(sock, *item)
+            except OSError:
+                break
+        for push_socket in push_sockets.values():
+            push_socket.close()
+
+    def _push_result(self, sock, push_sockets, message, body, addr, elapsed):
+        """
+        Entrega o resultado diretamente ao primeiro e avisa o líder.
+        O aviso é da forma "710 <comentário> (índice, iteração, chaves,
+        segundos de execução)"
+        A resposta vem da forma "200 <comentário>"
+        """
+
+        if addr not in push_sockets:
+            push_sockets[addr] = protocol.connect(addr)
+        protocol.send_message(push_sockets[addr], message, body)
+        notice = '710 Task done ({}, {}, {}, {:.6f})'.format(
+            *protocol.payload_info(body), elapsed)
+        protocol.send_message(sock, notice)
+
+    def _send_heartbeats(self, sending_queue):
+        """
+        Envia sinais de vida periódicos enquanto a conexão existir.
+        A mensagem é da forma "150 <comentário>", sem resposta
+        """
+
+        while True:
+            time.sleep(HEARTBEAT)
+            if self._sending_queue is not sending_queue:  # desconectado
+                break
+            sending_queue.put(('150 Heartbeat', b''))
+
     def _task_recv_request(self):
         """
-        Pedido de tarefa para o líder.
+        Pedidos de tarefas para o líder, até completar a janela.
         O pedido é da forma "600 <comentário>"
-        A resposta vem da forma "700 <comentário> (send_size)"
-        O retorno são os dados da lista ordenada
+        A resposta vem da forma "700 <comentário>" seguida das listas
         """
 
-        try:
-            self._send_message_to_leader('600 Give some task')
-            self._execute_response()
-        except:
-            raise
+        with self._lock:
+            while self._outstanding < self._window:
+                self._send_message_to_leader('600 Give some task')
+                self._outstanding += 1
 
-    def _task_send_request(self):
+    def _task_send_request(self, result, fetch_addr=None):
         """
-        Realiza um pedido de envio da tarefa pronta para o líder.
-        O pedido é da forma "700 <comentário> (send_size)"
-        A resposta vem da forma "900 <comentário>"
+        Envio da tarefa pronta para o líder, ou diretamente para o
+        primeiro, sem esperar pela resposta.
+        O pedido é da forma "700 <comentário> (segundos de execução)"
+        seguido da lista ordenada
+        A resposta vem da forma "200 <comentário>"
         """
 
-        try:
-            send_size = len(self._send_data)
-            message = '700 Sending completed task ({})'.format(send_size)
-            self._send_message_to_leader(message)
-            self._execute_response()
-        except:
-            raise
+        send_data, elapsed = result
+        if fetch_addr:
+            log = 'Sending result to First ({})'.format(fetch_addr[0])
+            self._print_log(log)
+            self._enqueue(('700 Sending completed task', send_data,
+                           fetch_addr, elapsed))
+            return
+        log = 'Sending result to Leader ({})'.format(self._leader_addr)
+        self._print_log(log)
+        self._send_message_to_leader(
+            '700 Sending completed task ({:.6f})'.format(elapsed), send_data)
 
     def _execute_response(self):
         """Executa a resposta do líder"""
-        data = self._data_socket.recv(BUFFER_SIZE)
-        if data:
-            code = self._get_code_from(data)
-
-            if code == '300':  # tornar-se líder
-                self._create_leader()
-                raise
-            elif code == '500':  # trabalho finalizado
-                self._undone = False
-                raise
-            elif code == '700':  # recebeu o tamanho dos dados do líder
-                self._recv_task(data)
-            elif code == '900':  # pronto para enviar os dados para o líder
-                self._send_task()
-        else:
-            raise
 
-    def _create_leader(self):
-        """Cria uma nova thread de líder"""
-        time.sleep(3)
+        message, body = protocol.recv_message(self._data_socket)
+        code = self._get_code_from(message)
+
+        if code == '300':  # tornar-se líder
+            self._create_leader(body)
+        elif code == '320':  # repasse da liderança
+            host, port = self._get_values_from(message)
+            self._next_leader = (host, int(port))
+            raise
+        elif code == '500':  # trabalho finalizado
+            self._undone = False
+            raise
+        elif code == '700':  # recebeu as listas ou o bilhete do líder
+            fetch_addr = None
+            if '(' in message:  # as listas são buscadas no primeiro
+                host, port = self._get_values_from(message)
+                fetch_addr = (host, int(port))
+            self._recv_task(body, fetch_addr)
+
+    def _create_leader(self, body):
+        """
+        Cria uma nova thread de líder com o estado do líder atual e
+        confirma quando o novo líder já está escutando.
+        A mensagem é da forma "310 <comentário> (endereço, porta dos
+        workers, porta do primeiro)"
+        A resposta vem da forma "320 <comentário> (endereço, porta)"
+        """
         self._print_log('Creating a new Leader')
-        t = threading.Thread(target=leader_t, args=(self._debug,))
+        state = json.loads(bytes(body).decode()) if len(body) else None
+        lo = leader(self._debug, state)
+        t = threading.Thread(target=lo.run)
         t.start()
+        host = self._data_socket.getsockname()[0]
+        self._send_message_to_leader('310 Leader ready ({}, {}, {})'.format(
+            host, *lo.ports()))
 
-    def _recv_task(self, data):
+    def _recv_task(self, body, fetch_addr=None):
         """
-        Envia uma mensagem de aceite para receber os dados.
-        Recebe os dados e realiza a ordenação das listas.
+        Recebe os dados e realiza a ordenação das listas, no próprio
+        worker ou em um dos processos executores. Com o endereço do
+        primeiro, o corpo é o bilhete da tarefa e as listas são buscadas
+        diretamente nele
         """
 
-        try:  # tenta enviar a mensagem de pronto
-            self._send_message_to_leader('900 Ready to receive')
-        except:
-            raise
+        log = 'Task received from Leader ({})'.format(self._leader_addr)
+        self._print_log(log)
+        if fetch_addr:
+            body = self._fetch_task(fetch_addr, body)
+            if body is None:  # tarefa já recebida pelo primeiro
+                self._task_done(self._generation, None)
+                return
+        if self._pool:
+            future = self._pool.submit(
+                execute_task, bytes(body), self._backend)
+            future.add_done_callback(functools.partial(
+                self._task_finished, self._generation, fetch_addr))
         else:
             try:
-                size = self._get_size_from(data)
-                data = self._data_socket.recv(size)
-                log = 'Task received from Leader ({})'.format(self._leader_addr)
-                self._print_log(log)
-                d = json.loads(data)
-            except:  # recebeu mensagem ao invés dos dados
-                self._task_cancel(data)
-            else:  # executa a tarefa
-                sorted = self._merge(d['a'], d['b'])
-
-                send_data = dict(index=d['index'],
-                                 sorted=sorted,
-                                 num_iter=d['num_iter'])
-                self._send_data = json.dumps(send_data).encode()
-
-    def _send_task(self):
-        """Transfere os dados enfileirados para o líder"""
+                result = execute_task(body, self._backend)
+            except ValueError:
+                result = None
+            self._task_done(self._generation, result, fetch_addr)
+
+    def _fetch_task(self, addr, ticket):
+        """
+        Busca as listas do bilhete diretamente no primeiro.
+        O pedido é da forma "800 <comentário>" seguido do bilhete
+        A resposta vem da forma "700 <comentário>" seguida das listas, ou
+        "404 <comentário>" se a tarefa não está mais pendente
+        """
 
         try:
-            log = 'Sending result to Leader ({})'.format(self._leader_addr)
-            self._print_log(log)
-            self._data_socket.sendall(self._send_data)
-        except:
-            self._task_cancel()
-            raise
+            if addr not in self._fetch_sockets:
+                self._fetch_sockets[addr] = protocol.connect(
+                    addr, FETCH_TIMEOUT)
+            sock = self._fetch_sockets[addr]
+            protocol.send_message(sock, '800 Fetch task', ticket)
+            message, body = protocol.recv_message(sock)
+        except OSError:
+            self._print_log('Cannot fetch task from First ({})'.format(
+                addr[0]))
+            sock = self._fetch_sockets.pop(addr, None)
+            if sock:
+                sock.close()
+            return None
+        return body if message.split()[0] == '700' else None
+
+    def _task_finished(self, generation, fetch_addr, future):
+        """Recebe o resultado de um processo executor"""
 
-    def _task_cancel(self, data=None):
-        """Procedimentos caso a tarefa seja abortada"""
-
-        data = self._data_socket.recv(BUFFER_SIZE) if not data else data
-        if data:
-            code = self._get_code_from(data)
-            if code == '300':  # tornar-se líder
-                self._create_leader()
-            elif code == '500':  # trabalho finalizado
-                self._undone = False
-
-    def _merge(self, a, b):
-        """recebe duas listas ordenadas e devolve a intercalação destas"""
-        c = []
-        i = 0
-        j = 0
-        while i < len(a) and j < len(b):
-            if a[i] <= b[j]:
-                c.append(a[i])
-                i += 1
+        try:
+            result = future.result()
+        except Exception:  # tarefa corrompida ou executor cancelado
+            result = None
+        self._task_done(generation, result, fetch_addr)
+
+    def _task_done(self, generation, result, fetch_addr=None):
+        """Envia o resultado e pede a próxima tarefa para a janela"""
+
+        with self._lock:
+            if generation != self._generation:  # tarefa de outro líder
+                return
+            self._outstanding -= 1
+            if result is None:
+                self._print_log('Invalid task from Leader')
             else:
-                c.append(b[j])
-                j += 1
-        while i < len(a):
-            c.append(a[i])
-            i += 1
-        while j < len(b):
-            c.append(b[j])
-            j += 1
-        return c
+                # responde no mesmo formato em que a tarefa foi recebida
+                self._task_send_request(result, fetch_addr)
+            self._task_recv_request()
 
     def _print_log(self, message):
         """Imprime uma mensagem de log com carimbo de tempo"""
@@ -232,31 +368,55 @@ class worker():
 
         return datetime.datetime.now().strftime('%H:%M:%S:%f')
 
-    def _send_message_to_leader(self, message):
-        """Envia uma mensagem para o líder"""
+    def _send_message_to_leader(self, message, body=b''):
+        """Envia uma mensagem para o líder, com o payload opcional"""
 
         self._print_log('Message to Leader ({}): {}'.format(
             self._leader_addr, message))
-        self._data_socket.sendall(message.encode())
+        self._enqueue((message, body))
 
-    def _get_code_from(self, data):
-        """Extrai o código pela resposta do líder"""
+    def _enqueue(self, item):
+        """Enfileira o envio, descartando-o se não houver conexão"""
 
-        resp = data.decode()
-        log = 'Message from Leader ({}): {}'.format(self._leader_addr, resp)
-        self._print_log(log)
-        return resp.split()[0]
+        sending_queue = self._sending_queue
+        if sending_queue is not None:
+            sending_queue.put(item)
 
-    def _get_size_from(self, data):
-        """Extrai o tamanho do buffer pela resposta do líder"""
+    def _get_values_from(self, message):
+        """Extrai os valores entre parênteses da mensagem"""
 
-        resp = data.decode()
-        return int(resp[resp.find('(')+1:resp.find(')')])
+        values = message[message.find('(')+1:message.find(')')].split(',')
+        return [value.strip() for value in values]
 
+    def _get_code_from(self, message):
+        """Extrai o código pela resposta do líder"""
 
-def leader_t(debug):
-    lo = leader(debug)
-    lo.run()
+        log = 'Message from Leader ({}): {}'.format(self._leader_addr, message)
+        self._print_log(log)
+        return message.split()[0]
+
+
+_backends = {}  # motores de ordenação já criados neste processo
+
+
+def execute_task(data, backend=None):
+    """
+    Decodifica a tarefa, ordena ou intercala as listas e devolve o
+    resultado codificado no mesmo formato da tarefa, com o tempo gasto
+    """
+
+    start = time.perf_counter()
+    if backend not in _backends:
+        _backends[backend] = merge.backend(backend)
+    engine = _backends[backend]
+    d = protocol.decode_task(data)
+    if d['sort']:  # fase de ordenação dos blocos iniciais
+        sorted = engine.sort_run(d['runs'][0])
+    else:
+        sorted = engine.merge_runs(d['runs'])
+    result = protocol.encode_result(
+        d['index'], sorted, d['num_iter'], d['format'])
+    return result, time.perf_counter() - start
 
 
 if __name__ == "__main__":